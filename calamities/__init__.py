@@ -32,9 +32,15 @@ from .layout import Layout
 from .text import Text, TextElement, TextElementCollection
 from .pattern import (
     tag_glob,
+    tag_glob_many,
+    tag_match,
+    atag_glob,
     has_magic,
     get_entities_in_path,
 )
+from .fileindex import FileIndex
+from .exclude import ExcludeRules
+from .manifest import ManifestIndex
 
 __all__ = [
     App,
@@ -59,8 +65,14 @@ __all__ = [
     DirectoryInputView,
     FilePatternInputView,
     tag_glob,
+    tag_glob_many,
+    tag_match,
+    atag_glob,
     has_magic,
     get_entities_in_path,
+    FileIndex,
+    ExcludeRules,
+    ManifestIndex,
     Layout,
     Text,
     TextElement,
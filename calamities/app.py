@@ -14,6 +14,7 @@ from .color import Color
 from .keyboard import Keyboard
 from .layout import Layout
 from .cursor import Cursor
+from .scheduler import ScanService
 
 frameDelaySeconds = 50. / 1000.  # 20 fps
 
@@ -26,6 +27,8 @@ class App:
         self.condition = threading.Condition()
         self.thread = threading.Thread(target=self.main)
 
+        self.scan_service = ScanService()
+
     def __enter__(self):
         with self.condition:
             self.thread.start()
@@ -34,6 +37,7 @@ class App:
     def __exit__(self, type, value, tb):
         self.should_quit = True
         self.thread.join()
+        self.scan_service.shutdown()
 
     def dispatch(self, func):
         self.queue.put_nowait(func)
@@ -2,5 +2,13 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+from typing import Callable, List, Union
+
+
 class Config:
     fs_root: str = "/"
+    dircache_max_entries: int = 1 << 20
+    exclude: List[Union[str, Callable[[str, bool], bool]]] = []
+    scan_debounce: float = 0.05
+    scan_max_wait: float = 0.3
+    scan_max_workers: int = 2
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+process-wide cache of directory listings that is validated against
+the directory mtime before reuse
+"""
+from typing import NamedTuple, Optional, Tuple
+
+import os
+from os import path as op
+from collections import OrderedDict
+from threading import Lock
+from time import time_ns
+
+from .config import Config
+
+
+class DirEntryInfo(NamedTuple):
+    name: str
+    is_dir: bool
+    is_file: bool
+    is_symlink: bool
+
+
+class Listing(NamedTuple):
+    st_dev: int
+    st_ino: int
+    mtime_ns: int
+    entries: Tuple[DirEntryInfo, ...]
+
+
+class DirCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    listings: int
+    entries: int
+    max_entries: int
+
+
+# a listing taken within this window of the directory mtime may miss
+# changes that do not advance a coarse-grained mtime, so it is not reused
+racy_window_ns = 2 * 10 ** 9
+
+
+def scandir_entries(path) -> Tuple[DirEntryInfo, ...]:
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                entries.append(
+                    DirEntryInfo(entry.name, entry.is_dir(), entry.is_file(), entry.is_symlink())
+                )
+            except OSError:
+                pass
+    return tuple(entries)
+
+
+class DirectoryCache:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+
+        self._listings: "OrderedDict[str, Listing]" = OrderedDict()
+        self._nentries = 0
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.watcher = None
+
+    def _get_max_entries(self) -> int:
+        if self.max_entries is not None:
+            return self.max_entries
+        return Config.dircache_max_entries
+
+    def listdir(self, path) -> Tuple[DirEntryInfo, ...]:
+        """
+        raises OSError like os.scandir if path cannot be listed
+        """
+        if not path:
+            path = os.curdir
+        key = op.abspath(path)
+
+        st = os.stat(key)
+
+        with self._lock:
+            listing = self._listings.get(key)
+            if (
+                listing is not None
+                and listing.mtime_ns == st.st_mtime_ns
+                and listing.st_ino == st.st_ino
+                and listing.st_dev == st.st_dev
+            ):
+                self._listings.move_to_end(key)
+                self.hits += 1
+                return listing.entries
+            self.misses += 1
+
+        watcher = self.watcher
+        if watcher is not None:
+            watcher.watch(key)  # before listing so that no change is missed
+
+        entries = scandir_entries(key)
+
+        if time_ns() - st.st_mtime_ns > racy_window_ns:
+            self._store(key, Listing(st.st_dev, st.st_ino, st.st_mtime_ns, entries))
+        else:
+            self.invalidate(key)
+
+        return entries
+
+    def identity(self, path) -> Optional[Tuple[int, int]]:
+        """
+        (st_dev, st_ino) of a directory, from the cache where possible
+        """
+        key = op.abspath(path or os.curdir)
+        with self._lock:
+            listing = self._listings.get(key)
+        if listing is not None:
+            return (listing.st_dev, listing.st_ino)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _store(self, key, listing):
+        max_entries = self._get_max_entries()
+        if len(listing.entries) > max_entries:
+            self.invalidate(key)
+            return
+
+        with self._lock:
+            old = self._listings.pop(key, None)
+            if old is not None:
+                self._nentries -= len(old.entries)
+            self._listings[key] = listing
+            self._nentries += len(listing.entries)
+
+            while self._nentries > max_entries:
+                _, evicted = self._listings.popitem(last=False)
+                self._nentries -= len(evicted.entries)
+
+    def invalidate(self, path):
+        key = op.abspath(path)
+        with self._lock:
+            old = self._listings.pop(key, None)
+            if old is not None:
+                self._nentries -= len(old.entries)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._nentries = 0
+
+    def info(self) -> DirCacheInfo:
+        with self._lock:
+            return DirCacheInfo(
+                self.hits, self.misses, len(self._listings), self._nentries, self._get_max_entries()
+            )
+
+
+dircache = DirectoryCache()
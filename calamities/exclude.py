@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+rules for paths that are never listed, so that the subtrees below
+excluded directories are skipped entirely
+"""
+from typing import Callable, List, NamedTuple, Optional, Union
+
+import re
+
+from .config import Config
+
+Rule = Union[str, Callable[[str, bool], bool]]
+
+
+class _CompiledRule(NamedTuple):
+    fullmatch: Optional[Callable]
+    predicate: Optional[Callable[[str, bool], bool]]
+    negate: bool
+    dironly: bool
+    basename: bool
+
+
+def _translate_rule(pat) -> str:
+    """
+    translate a gitignore-style glob, where * and ? do not match a
+    slash and ** matches any number of directories
+    """
+    i, n = 0, len(pat)
+    res = ""
+    while i < n:
+        if pat.startswith("**/", i):
+            res += r"(?:.*/)?"
+            i += 3
+        elif pat.startswith("**", i):
+            res += r".*"
+            i += 2
+        else:
+            c = pat[i]
+            i += 1
+            if c == "*":
+                res += r"[^/]*"
+            elif c == "?":
+                res += r"[^/]"
+            elif c == "[":
+                j = i + 1 if pat.startswith("!", i) else i
+                j = pat.find("]", j + 1)
+                if j < 0:
+                    res += re.escape(c)
+                    continue
+                stuff = pat[i:j].replace("\\", "\\\\")
+                if stuff.startswith("!"):
+                    stuff = "^" + stuff[1:]
+                res += f"[{stuff}]"
+                i = j + 1
+            elif c == "\\" and i < n:
+                res += re.escape(pat[i])
+                i += 1
+            else:
+                res += re.escape(c)
+    return res
+
+
+def _compile_rule(rule: Rule) -> Optional[_CompiledRule]:
+    if callable(rule):
+        return _CompiledRule(None, rule, False, False, False)
+
+    pat = rule.strip()
+    if len(pat) == 0 or pat.startswith("#"):
+        return None
+
+    negate = pat.startswith("!")
+    if negate:
+        pat = pat[1:]
+
+    dironly = pat.endswith("/")
+    pat = pat.rstrip("/")
+    if len(pat) == 0:
+        return None
+
+    basename = "/" not in pat
+    if basename:
+        res = _translate_rule(pat)
+    elif pat.startswith("/"):  # anchored at the file system root
+        res = _translate_rule(pat)
+    else:  # matches at any depth, but only at component boundaries
+        res = r"(?:.*/)?" + _translate_rule(pat)
+
+    return _CompiledRule(re.compile(res).fullmatch, None, negate, dironly, basename)
+
+
+class ExcludeRules:
+    """
+    rules are gitignore-style globs or predicates that take the path and
+    whether it is a directory. globs without a slash match the basename,
+    globs with a slash match the absolute path, and a trailing slash only
+    matches directories. as in gitignore, the last rule that matches
+    decides, and a rule that starts with ! includes the path again
+    """
+
+    def __init__(self, rules=None):
+        self.rules: List[Rule] = list(rules) if rules is not None else list()
+        self._compiled = [
+            compiled for compiled in map(_compile_rule, self.rules) if compiled is not None
+        ]
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __reduce__(self):
+        return (ExcludeRules, (self.rules,))
+
+    def excluded(self, path, is_dir) -> bool:
+        """
+        path needs to be absolute for globs that contain a slash
+        """
+        path = path.rstrip("/") or "/"
+        name = path.rpartition("/")[2]
+        for rule in reversed(self._compiled):
+            if rule.dironly and not is_dir:
+                continue
+            if rule.predicate is not None:
+                if rule.predicate(path, is_dir):
+                    return True
+                continue
+            if rule.fullmatch(name if rule.basename else path) is not None:
+                return not rule.negate
+        return False
+
+
+def exclude_rules(rules=None) -> ExcludeRules:
+    """
+    rules default to Config.exclude
+    """
+    if isinstance(rules, ExcludeRules):
+        return rules
+    if rules is None:
+        rules = Config.exclude
+    return ExcludeRules(rules)
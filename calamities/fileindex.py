@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+persistent sqlite index of a directory tree that tag_glob can query
+instead of the file system
+"""
+from typing import List, NamedTuple, Optional, Tuple
+
+import os
+from os import path as op
+import sqlite3
+from threading import Lock
+from time import time_ns
+
+from .config import Config
+from .dircache import DirEntryInfo, dircache, scandir_entries, racy_window_ns
+
+# the listings of this many directories are written in one transaction
+refresh_batch_size = 256
+
+schema = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    st_dev INTEGER NOT NULL,
+    st_ino INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+    dirpath TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    is_file INTEGER NOT NULL,
+    is_symlink INTEGER NOT NULL,
+    PRIMARY KEY (dirpath, name)
+) WITHOUT ROWID;
+"""
+
+
+def _normalize(path) -> str:
+    return op.normpath(op.abspath(path))
+
+
+def _subtree_range(path) -> Tuple[str, str]:
+    prefix = op.join(path, "")
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class _Listing(NamedTuple):
+    dirpath: str
+    st: Optional[os.stat_result]  # None if the directory is gone
+    mtime_ns: int
+    entries: Tuple[DirEntryInfo, ...]
+
+
+class FileIndex:
+    """
+    stores the listing, device, inode and mtime of every directory
+    below root. refresh only re-lists directories whose mtime changed
+
+    directories that are not in the index, for example because they are
+    outside root or reached through a symlink, are listed through the
+    shared directory cache
+    """
+
+    def __init__(self, database, root=None):
+        if root is None:
+            root = Config.fs_root
+        self.root = _normalize(root)
+        self.database = database
+
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._lock = Lock()
+
+        with self._lock, self._connection:
+            self._connection.executescript(schema)
+
+    def __reduce__(self):
+        # worker processes open their own connection
+        return (FileIndex, (self.database, self.root))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def listdir(self, path) -> Tuple[DirEntryInfo, ...]:
+        """
+        same interface as DirectoryCache.listdir
+        """
+        if not path:
+            path = os.curdir
+        key = _normalize(path)
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM directories WHERE path = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                rows = self._connection.execute(
+                    "SELECT name, is_dir, is_file, is_symlink FROM entries WHERE dirpath = ?",
+                    (key,),
+                ).fetchall()
+                return tuple(
+                    DirEntryInfo(name, bool(is_dir), bool(is_file), bool(is_symlink))
+                    for name, is_dir, is_file, is_symlink in rows
+                )
+
+        return dircache.listdir(key)
+
+    def identity(self, path) -> Optional[Tuple[int, int]]:
+        """
+        same interface as DirectoryCache.identity
+        """
+        key = _normalize(path or os.curdir)
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT st_dev, st_ino FROM directories WHERE path = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            return row
+
+        return dircache.identity(key)
+
+    def refresh(self, path=None) -> int:
+        """
+        bring the index up to date below path, which defaults to root,
+        and return the number of directories that had to be listed
+
+        the tree is walked without holding the lock, and the listings
+        are written in batches of refresh_batch_size directories, so that
+        a concurrent listdir only waits while a batch is written
+        """
+        if path is None:
+            path = self.root
+        path = _normalize(path)
+
+        nlisted = 0
+        stack = [path]
+        batch: List[_Listing] = list()
+
+        while len(stack) > 0:
+            dirpath = stack.pop()
+
+            try:
+                st = os.stat(dirpath)
+            except OSError:
+                batch.append(_Listing(dirpath, None, 0, ()))
+                continue
+
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT st_dev, st_ino, mtime_ns FROM directories WHERE path = ?",
+                    (dirpath,),
+                ).fetchone()
+                if row == (st.st_dev, st.st_ino, st.st_mtime_ns):
+                    subdirs = [
+                        name
+                        for (name,) in self._connection.execute(
+                            "SELECT name FROM entries "
+                            "WHERE dirpath = ? AND is_dir AND NOT is_symlink",
+                            (dirpath,),
+                        )
+                    ]
+                else:
+                    subdirs = None
+
+            if subdirs is None:
+                listing = self._list(dirpath, st)
+                batch.append(listing)
+                subdirs = [
+                    entry.name
+                    for entry in listing.entries
+                    if entry.is_dir and not entry.is_symlink
+                ]
+                nlisted += 1
+
+            stack.extend(op.join(dirpath, name) for name in subdirs)
+
+            if len(batch) >= refresh_batch_size:
+                self._write(batch)
+                batch = list()
+
+        self._write(batch)
+
+        return nlisted
+
+    def _list(self, dirpath, st) -> _Listing:
+        try:
+            entries = scandir_entries(dirpath)
+        except OSError:
+            return _Listing(dirpath, None, 0, ())
+
+        mtime_ns = st.st_mtime_ns
+        if time_ns() - mtime_ns <= racy_window_ns:
+            mtime_ns = -1  # list again on the next refresh
+
+        return _Listing(dirpath, st, mtime_ns, tuple(entries))
+
+    def _write(self, batch: List[_Listing]):
+        if len(batch) == 0:
+            return
+        with self._lock, self._connection:
+            for listing in batch:
+                if listing.st is None:
+                    self._remove(listing.dirpath)
+                else:
+                    self._store(listing)
+
+    def _store(self, listing: _Listing):
+        dirpath, st, mtime_ns, entries = listing
+
+        subdirs = set(entry.name for entry in entries if entry.is_dir and not entry.is_symlink)
+
+        old_subdirs = set(
+            name
+            for (name,) in self._connection.execute(
+                "SELECT name FROM entries WHERE dirpath = ? AND is_dir AND NOT is_symlink",
+                (dirpath,),
+            )
+        )
+        for name in old_subdirs - subdirs:
+            self._remove(op.join(dirpath, name))
+
+        self._connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+            (dirpath, st.st_dev, st.st_ino, mtime_ns),
+        )
+        self._connection.execute("DELETE FROM entries WHERE dirpath = ?", (dirpath,))
+        self._connection.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+            (
+                (dirpath, entry.name, entry.is_dir, entry.is_file, entry.is_symlink)
+                for entry in entries
+            ),
+        )
+
+    def _remove(self, dirpath):
+        start, stop = _subtree_range(dirpath)
+        for table, column in [("directories", "path"), ("entries", "dirpath")]:
+            self._connection.execute(
+                f"DELETE FROM {table} WHERE {column} = ? OR ({column} >= ? AND {column} < ?)",
+                (dirpath, start, stop),
+            )
@@ -5,7 +5,8 @@
 """
 
 """
-import os
+from typing import NamedTuple, Optional, Tuple
+
 from os import path as op
 
 from ..keyboard import Key
@@ -13,10 +14,35 @@ from ..view import CallableView
 from .text import TextInputView, common_chars
 from .choice import SingleChoiceInputView
 from ..file import get_dir, resolve
+from ..dircache import dircache
+from ..exclude import exclude_rules
+from ..scheduler import ScanScheduler
+
+
+class _ListRequest(NamedTuple):
+    dir: Optional[str]
+    basename: str
+
+
+class _DirListing(NamedTuple):
+    """
+    the entries of a directory. the scheduler thread only ever replaces
+    the whole listing, and the app thread filters it by the typed text
+    """
+
+    dir: Optional[str]
+    files: Tuple[str, ...]
+
+
+class _FileSuggestions(NamedTuple):
+    request: _ListRequest
+    matching_files: Tuple[str, ...]
 
 
 class FileInputView(CallableView):
-    def __init__(self, base_path=None, exists=True, messagefun=None, **kwargs):
+    def __init__(
+        self, base_path=None, exists=True, messagefun=None, watcher=None, exclude=None, **kwargs
+    ):
         super(FileInputView, self).__init__(**kwargs)
         self.text_input_view = TextInputView(
             base_path, messagefun=messagefun, forbidden_chars="'\"'", maxlen=256
@@ -25,10 +51,14 @@ class FileInputView(CallableView):
         self.suggestion_view = SingleChoiceInputView([], isVertical=True, addBrackets=False)
         self.suggestion_view.update = self.update
 
-        self.matching_files = []
-        self.cur_dir = None
-        self.cur_dir_files = []
+        self.matching_files: Tuple[str, ...] = ()
         self.exists = exists
+        self.watcher = watcher
+        self.exclude = exclude_rules(exclude)
+        self.scheduler = ScanScheduler(self._list_dir)
+        self._list_request = _ListRequest(None, "")
+        self._listing = _DirListing(None, ())
+        self._suggestions: Optional[_FileSuggestions] = None
 
     @property
     def text(self):
@@ -48,8 +78,23 @@ class FileInputView(CallableView):
     def _before_call(self):
         self.text_input_view._before_call()
         self.text_input_view.isActive = True
+        if self.watcher is not None:
+            self.watcher.subscribe(self._on_directories_changed)
+        self.scheduler.start(self.layout.app.scan_service)
         self._scan_files()
 
+    def _after_call(self):
+        if self.watcher is not None:
+            self.watcher.unsubscribe(self._on_directories_changed)
+        self.scheduler.stop()
+        self.layout.app.dispatch(self._clear_suggestions)
+        super(FileInputView, self)._after_call()
+
+    def _on_directories_changed(self, dirpaths):
+        dir = self._list_request.dir
+        if dir is not None and resolve(dir) in dirpaths:
+            self.scheduler.refresh()  # lists the directory again
+
     def _is_ok(self):
         if self.exists:
             try:
@@ -67,48 +112,96 @@ class FileInputView(CallableView):
             except Exception:
                 pass
 
-    def _scan_dir(self):
-        path = str(self.text).strip()
-        dir = get_dir(path)
-        if dir != self.cur_dir:
-            self.cur_dir = dir
-            self.cur_dir_files = []
+    def _include(self, entry) -> bool:
+        return True
 
-            try:
-                real_dir = resolve(self.cur_dir)
-                with os.scandir(real_dir) as it:
-                    for entry in it:
-                        try:
-                            filepath = entry.name
-                            if filepath[0] == ".":
-                                continue
-                            if entry.is_dir():
-                                filepath += "/"
-                            self.cur_dir_files.append(filepath)
-                        except OSError:
-                            pass
-            except OSError:
-                pass
+    def _list_dir(self, generation):
+        """
+        runs in the scheduler thread, so that slow file systems do not
+        block typing
+        """
+        dir = self._list_request.dir
+        if dir is None:
+            return
+
+        files = []
+        try:
+            real_dir = resolve(dir)
+            entries = dircache.listdir(real_dir)
+        except OSError:
+            entries = ()
+
+        for entry in entries:
+            filepath = entry.name
+            if filepath[0] == ".":
+                continue
+            if not self._include(entry):
+                continue
+            if self.exclude and self.exclude.excluded(op.join(real_dir, filepath), entry.is_dir):
+                continue
+            if entry.is_dir:
+                filepath += "/"
+            files.append(filepath)
+
+        if self.scheduler.is_current(generation):
+            self._listing = _DirListing(dir, tuple(files))
+            self.layout.app.dispatch(self._filter_files)
 
     def _scan_files(self):
+        """
+        called from the ui thread. the directory is only listed again when
+        it has changed, the typed text is matched in the app thread
+        """
         if self.text is None:
             return
 
-        self._scan_dir()
+        path = str(self.text).strip()
+        list_request = _ListRequest(get_dir(path), op.basename(self.text))
+        is_new_dir = list_request.dir != self._list_request.dir
+        self._list_request = list_request
+        if is_new_dir:
+            self.scheduler.request()
+        self.layout.app.dispatch(self._filter_files)
+
+    def _filter_files(self):
+        """
+        called from the app thread with the latest listing and text
+        """
+        list_request = self._list_request
+        listing = self._listing
+        if listing.dir != list_request.dir:
+            files: Tuple[str, ...] = ()  # is still being listed
+        else:
+            files = listing.files
+        matching_files = tuple(
+            sorted(entry for entry in files if entry.startswith(list_request.basename))
+        )
+        self.matching_files = matching_files
+        self.suggestion_view.set_options(list(matching_files))
+        self.update()
+
+        self._suggestions = _FileSuggestions(list_request, matching_files)
 
-        new_matching_files = []
-        basename = op.basename(self.text)
-        for entry in self.cur_dir_files:
-            if entry.startswith(basename):
-                new_matching_files.append(entry)
-        new_matching_files.sort()
-        self.matching_files = new_matching_files
-        self.suggestion_view.set_options(self.matching_files)
+    def _clear_suggestions(self):
+        """
+        called from the app thread, after the listings that were
+        dispatched before
+        """
+        self.suggestion_view.set_options([])
+
+    def _get_matching_files(self) -> Tuple[str, ...]:
+        """
+        the suggestions for the current text, or none while they are
+        still being filtered
+        """
+        suggestions = self._suggestions
+        if suggestions is None or suggestions.request is not self._list_request:
+            return ()
+        return suggestions.matching_files
 
     def _handleKey(self, c):
         if c == Key.Break:
             self.text = None
-            self.suggestion_view.set_options([])
             self.isActive = False
         elif self.suggestion_view.isActive and self.suggestion_view.cur_index is not None:
             if c == Key.Up and self.suggestion_view.cur_index == 0:
@@ -137,18 +230,18 @@ class FileInputView(CallableView):
                 self.suggestion_view._handleKey(c)
         else:
             cur_text = self.text
-            if c == Key.Down and len(self.matching_files) > 0:
+            matching_files = self._get_matching_files()
+            if c == Key.Down and len(matching_files) > 0:
                 self.suggestion_view.isActive = True
                 self.text_input_view.isActive = False
                 self.suggestion_view._before_call()
                 self.update()
-            elif c == Key.Tab and len(self.matching_files) > 0:
-                cc = common_chars(self.matching_files)
+            elif c == Key.Tab and len(matching_files) > 0:
+                cc = common_chars(matching_files)
                 self.text = op.join(op.dirname(str(self.text)), cc)
                 self.text_input_view.cur_index = len(self.text)
             elif c == Key.Return:
                 if self._is_ok():
-                    self.suggestion_view.set_options([])
                     self.suggestion_view.isActive = False
                     self.text_input_view.isActive = False
                     self.isActive = False
@@ -190,25 +283,5 @@ class DirectoryInputView(FileInputView):
                 return False
         return True
 
-    def _scan_dir(self):
-        path = str(self.text).strip()
-        dir = get_dir(path)
-        if dir != self.cur_dir:
-            self.cur_dir = dir
-            self.cur_dir_files = []
-
-            try:
-                real_dir = resolve(self.cur_dir)
-                with os.scandir(real_dir) as it:
-                    for entry in it:
-                        try:
-                            filepath = entry.name
-                            if filepath[0] == ".":
-                                continue
-                            if entry.is_dir():
-                                filepath += "/"
-                                self.cur_dir_files.append(filepath)
-                        except OSError:
-                            pass
-            except OSError:
-                pass
+    def _include(self, entry) -> bool:
+        return entry.is_dir
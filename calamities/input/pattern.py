@@ -5,11 +5,15 @@
 """
 
 """
-from typing import Any, Optional, Dict, List
+from typing import Any, NamedTuple, Optional, Dict, List, Set, Tuple
 
 import os
+import re
+import math
+import sqlite3
 from os import path as op
-from threading import Thread, Event
+from time import monotonic
+from threading import Lock
 from operator import attrgetter
 
 import inflect
@@ -21,19 +25,113 @@ from .text import TextInputView, common_chars
 from .choice import SingleChoiceInputView
 from ..text import TextElement, TextElementCollection, Text
 from ..file import resolve
+from ..dircache import dircache
+from ..exclude import exclude_rules
+from ..scheduler import ScanScheduler
+from ..watch import ChangedDirectories
 from ..pattern import (
     tag_glob,
+    has_magic,
     tag_parse,
     tokenize,
     suggestion_match,
     show_tag_suggestion_check,
     remove_tag_remainder_match,
+    TagColumns,
+    CancelToken,
+    GlobProcessPool,
+    UnsafeFilterError,
 )
+from ..pattern.estimate import estimate_tag_glob
+from ..pattern.match import PathTree
+
+estimate_timeout = 0.1
+
+# partial results are shown after this many seconds or new matches
+publish_interval = 0.05
+publish_batch = 500
+
+# the count of the files found so far is updated after this many seconds
+refine_interval = 0.25
 
 logger = logging.getLogger("calamities")
 p = inflect.engine()
 
 
+class _ScanCache(NamedTuple):
+    pathname: str
+    paths: List[str]
+
+
+class _ScanRequest(NamedTuple):
+    text: Optional[str]
+    cur_index: int
+    token: CancelToken
+
+
+class _ScanSnapshot(NamedTuple):
+    """
+    what a scan shows in the view. the scan thread only ever replaces the
+    whole snapshot, and the ui thread applies it to the view, so that the
+    view never sees a half-updated result
+    """
+
+    generation: int
+    message: Optional[Text]  # None keeps the current message
+    is_ok: bool
+    is_complete: bool
+    is_suggesting_entities: bool
+    matching_files: Tuple[Text, ...]
+    tag_suggestions: Tuple[Text, ...]
+    options: Tuple[Text, ...]
+    error: Optional[str]  # is shown in the status bar
+
+
+def _is_refinement(old, new) -> bool:
+    """
+    whether every path that matches new also matches old. this is the
+    case when characters are appended to the basename, or when a tag
+    without a filter gets a filter that cannot match an empty value
+    """
+    if new.startswith(old):
+        appended = new[len(old) :]
+        if any(c in appended for c in "/{}[]\\"):
+            return False
+        basename = op.basename(old)
+        return (
+            not basename.endswith("\\")
+            and basename.count("{") == basename.count("}")
+            and basename.count("[") == basename.count("]")
+        )
+
+    old_tokens, new_tokens = tokenize.split(old), tokenize.split(new)
+    if len(old_tokens) != len(new_tokens):
+        return False
+    for old_token, new_token in zip(old_tokens, new_tokens):
+        if old_token == new_token:
+            continue
+        old_match = tag_parse.fullmatch(old_token)
+        new_match = tag_parse.fullmatch(new_token)
+        if old_match is None or new_match is None:
+            return False
+        if old_match.group("tag_name") != new_match.group("tag_name"):
+            return False
+        if old_match.group("filter") is not None:
+            return False
+        new_filter = new_match.group("filter")
+        if new_match.group("filter_type") == "=":
+            if len(new_filter.replace("*", "")) == 0:
+                return False
+        else:
+            try:
+                new_filter = new_filter.replace("\\{", "{").replace("\\}", "}")
+                if re.fullmatch(new_filter, "") is not None:
+                    return False
+            except re.error:
+                return False
+    return True
+
+
 class NestedTextInputView(TextInputView):
     def __init__(self, parent_view: CallableView, *args, **kwargs):
         self.parent_view = parent_view
@@ -60,6 +158,13 @@ class FilePatternInputView(CallableView):
         entity_colors_list=["ired", "igreen", "imagenta", "icyan", "iyellow"],
         dironly=False,
         base_path=None,
+        backend=None,
+        manifest=None,
+        watcher=None,
+        processes=None,
+        exclude=None,
+        tag_filters=None,
+        estimate=True,
         **kwargs,
     ):
         super(FilePatternInputView, self).__init__(**kwargs)
@@ -83,6 +188,13 @@ class FilePatternInputView(CallableView):
         self.cur_dir = None
         self.cur_dir_files = []
         self.dironly = dironly
+        self.backend = backend
+        self.manifest = manifest
+        self.watcher = watcher
+        self.processes = processes
+        self.exclude = exclude_rules(exclude)
+        self.tag_filters = tag_filters
+        self.estimate = estimate
         self.is_ok = False
 
         self.entities = entities
@@ -93,10 +205,15 @@ class FilePatternInputView(CallableView):
         self.is_suggesting_entities = False
         self.tab_pressed = False
 
-        self._scan_thread = None
-        self._is_scanning = True
-        self._scan_requested_event = Event()
-        self._scan_complete_event = Event()
+        self.scheduler = ScanScheduler(self._scan)
+        self._scan_root: Optional[str] = None
+        self._scan_cache: Optional[_ScanCache] = None
+        self._changed_dirs: Set[str] = set()
+        self._changed_dirs_lock = Lock()
+        self._processes: Any = None  # a GlobProcessPool or an executor
+        self._scan_request = _ScanRequest(None, 0, CancelToken())
+        self._snapshot = _ScanSnapshot(0, None, False, False, False, (), (), (), None)
+        self._applied_snapshot: Optional[_ScanSnapshot] = None
 
     @property
     def text(self):
@@ -104,8 +221,8 @@ class FilePatternInputView(CallableView):
 
     @text.setter
     def text(self, val):
-        self._scan_files()
         self.text_input_view.text = val
+        self._scan_files()
 
     def show_message(self, msg):
         if isinstance(msg, Text):
@@ -114,23 +231,136 @@ class FilePatternInputView(CallableView):
             self.message = self._tokenize(msg, addBrackets=False)
         self.message_is_dirty = True
 
-    def _suggest_entities(self):
-        self.matching_files = []
-
-        self.is_suggesting_entities = True
-        self._update_suggestion_view(self.tag_suggestions)
-
-    def _suggest_matches(self):
-        self.tag_suggestions = []
-        self.is_suggesting_entities = False
-        self._update_suggestion_view(self.matching_files)
+    def _tag_message(self, nvaluedict) -> str:
+        if len(nvaluedict) == 0:
+            return ""
+        tagmessages = [p.inflect(f"{n} plural('{k}', {n})") for k, n in nvaluedict.items()]
+        return " for " + p.join(tagmessages)
+
+    def _estimate_message(self, nfile, estimate) -> Optional[Text]:
+        """
+        a provisional count from the estimate and the files found so far,
+        as long as nothing else was written to the message
+        """
+        if self.message_is_dirty:
+            return None
+
+        nvaluedict = dict(estimate.nunique)
+        nvaluedict.pop("suggestion", None)
+        if not all(entity in nvaluedict for entity in self.required_entities):
+            return None
+
+        nestimate = max(nfile, round(estimate.matches))
+        about = "" if estimate.exact else "about "
+        if nfile > 0:
+            value = p.inflect(f"Found {nfile} of {about}{nestimate} plural('file', {nestimate})")
+        else:
+            value = p.inflect(f"Found {about}{nestimate} plural('file', {nestimate})")
+        value += self._tag_message(nvaluedict)
+        if not estimate.exact:
+            error = 2 * estimate.relative_error  # roughly 95% confidence
+            if math.isfinite(error):
+                value += f" (±{max(1, math.ceil(100 * error))}%)"
+            else:
+                value += " (?)"
+
+        return TextElement(value, self.layout.color.default)
+
+    def _progress_message(self, columns, estimate) -> Optional[Text]:
+        """
+        the number of files found so far, which is provisional until the
+        scan is complete
+        """
+        if estimate is not None:
+            return self._estimate_message(len(columns), estimate)
+        nfile = len(columns)
+        if nfile == 0 or self.message_is_dirty:
+            return None
+        nvaluedict = columns.nunique()
+        nvaluedict.pop("suggestion", None)
+        value = p.inflect(f"Found {nfile} plural('file', {nfile}) so far")
+        value += self._tag_message(nvaluedict)
+        return TextElement(value, self.layout.color.default)
+
+    def _publish(self, snapshot: _ScanSnapshot):
+        """
+        called from the scan thread. results for older text are dropped.
+        the snapshot is applied in the app thread, which also draws the
+        view, so that the view is only ever changed from one thread
+        """
+        if not self.scheduler.is_current(snapshot.generation):
+            return
+        self._snapshot = snapshot
+        self.layout.app.dispatch(self._apply_snapshot)
+        self.update()
 
-    def _update_suggestion_view(self, options: List[Text]):
-        options = sorted(options, key=attrgetter("value"))
-        self.suggestion_view.set_options(options)
+    def _publish_error(self, generation, error: str):
+        """
+        the scan is reported as complete with nothing found, so that the
+        user sees why instead of waiting
+        """
+        message = TextElement(error, self.layout.color.iyellow)
+        self._publish(_ScanSnapshot(generation, message, False, True, False, (), (), (), error))
+
+    def _publish_filter_error(self, generation, e):
+        """
+        a filter that could hang the scan is reported instead of matched
+        """
+        logger.debug("Unsafe filter: %s", e)
+        self._publish_error(generation, str(e))
+
+    def _publish_backend_error(self, generation, e):
+        """
+        a manifest or index that cannot be read is reported, as the
+        scan cannot run without it
+        """
+        logger.debug("Error reading files: %s", e, exc_info=True)
+        self._publish_error(generation, f"Cannot read files: {e}")
+
+    def _apply_snapshot(self):
+        """
+        called from the app thread
+        """
+        snapshot = self._snapshot
+        previous = self._applied_snapshot
+        if snapshot is previous:
+            return
+
+        if not self.isActive:
+            pass  # the status bar belongs to the next view
+        elif snapshot.error is not None:
+            self._setStatusBar(snapshot.error)
+        elif previous is not None and previous.error is not None:
+            self._restore_status_bar()
+
+        if snapshot.message is not None:
+            self.message = snapshot.message
+        if snapshot.is_complete:
+            self.message_is_dirty = False
 
-        self._scan_complete_event.set()
-        self.update()
+        self.is_ok = snapshot.is_ok
+        self.is_suggesting_entities = snapshot.is_suggesting_entities
+        self.matching_files = list(snapshot.matching_files)
+        self.tag_suggestions = list(snapshot.tag_suggestions)
+        self.suggestion_view.set_options(list(snapshot.options))
+
+        self._applied_snapshot = snapshot  # the key handler may now use it
+
+    def _clear_suggestions(self):
+        """
+        called from the app thread, after the snapshots that were
+        dispatched before
+        """
+        self.suggestion_view.set_options([])
+
+    def _restore_status_bar(self):
+        """
+        shows the keys of the active view again
+        """
+        if self.suggestion_view.isActive:
+            self.suggestion_view._before_call()
+        else:
+            self.text_input_view._before_call()
 
     def _tokenize(self, text, addBrackets=True):
         if addBrackets:
@@ -178,19 +408,107 @@ class FilePatternInputView(CallableView):
         self.text_input_view._before_call()
         self.text_input_view.isActive = True
 
-        self._scan_thread = Thread(target=self._scan_files_loop)
-        self._is_scanning = True
-        self._scan_thread.start()
+        self._scan_cache = None  # the files may have changed since
+        self._take_changed_dirs()
+
+        scan_service = self.layout.app.scan_service
+        self._processes = self.processes
+        if self._processes is not None:
+            try:
+                GlobProcessPool.check_args(self.exclude, self.tag_filters)
+            except ValueError as e:
+                logger.warning("%s, matching in this process instead", e)
+                self._processes = None
+        if isinstance(self._processes, int):
+            # matching runs in worker processes, so it does not compete
+            # with the ui for the GIL
+            self._processes = scan_service.process_pool(self._processes)
+
+        self.scheduler.start(scan_service)
+
+        if self.watcher is not None:
+            self.watcher.subscribe(self._on_directories_changed)
 
         self._scan_files()
 
     def _after_call(self):
-        self._is_scanning = False
-        self._scan_thread.join()
+        if self.watcher is not None:
+            self.watcher.unsubscribe(self._on_directories_changed)
+
+        self._scan_request.token.cancel()
+        self.scheduler.stop()
+        self.layout.app.dispatch(self._clear_suggestions)
+
+        self._processes = None  # a process pool is kept by the scan service
+
         super()._after_call()
 
+    def _on_directories_changed(self, dirpaths):
+        # the changed directories were invalidated in the listing cache, so
+        # the next scan lists and matches only these again. the running
+        # scan is neither cancelled nor made stale, so that it can still
+        # show its results and fill the cache
+        scan_root = self._scan_root
+        if scan_root is None:
+            return
+        scan_root = op.join(scan_root, "")
+        dirpaths = [dirpath for dirpath in dirpaths if op.join(dirpath, "").startswith(scan_root)]
+        if len(dirpaths) > 0:
+            with self._changed_dirs_lock:
+                self._changed_dirs.update(dirpaths)
+            self.scheduler.refresh()
+
+    def _take_changed_dirs(self) -> Set[str]:
+        with self._changed_dirs_lock:
+            changed_dirs, self._changed_dirs = self._changed_dirs, set()
+        return changed_dirs
+
+    def _update_scan_cache(self, scan_cache, changed_dirs, token) -> Optional[_ScanCache]:
+        """
+        matches the pattern of the cache again where the changed
+        directories may have changed the result, and keeps the cached
+        paths from everywhere else
+        """
+        backend = ChangedDirectories(self.backend or dircache, changed_dirs, scan_cache.paths)
+
+        paths = [path for path in scan_cache.paths if not backend.is_changed(path)]
+        try:
+            for record in tag_glob(
+                resolve(scan_cache.pathname + "{suggestion:.*}"),
+                self.entities + ["suggestion"],
+                self.dironly,
+                backend=backend,
+                token=token,
+                records=True,
+                exclude=self.exclude,
+                tag_filters=self.tag_filters,
+            ):
+                if backend.is_changed(record.path) and self._is_cached(record):
+                    paths.append(record.path)
+        except (ValueError, AssertionError) as e:
+            logger.debug("Error updating scanned files: %s", e, exc_info=True)
+            return None
+
+        return _ScanCache(scan_cache.pathname, paths)
+
+    def _is_candidate(self, record) -> bool:
+        if self.dironly is True:
+            return record.is_dir
+        else:
+            return record.is_file
+
+    def _is_cached(self, record) -> bool:
+        return len(record.tagdict.get("suggestion", "")) > 0 or self._is_candidate(record)
+
     def _is_ok(self):
-        return self.is_ok
+        # until the scan of the current text is complete, is_ok is from an
+        # older one
+        snapshot = self._snapshot
+        return (
+            snapshot.is_ok
+            and snapshot.is_complete
+            and snapshot.generation == self.scheduler.generation
+        )
 
     def _getOutput(self):
         if self.text is not None:
@@ -198,173 +516,330 @@ class FilePatternInputView(CallableView):
             return resolve(path)
 
     def _scan_files(self):
-        self._scan_requested_event.set()
-
-    def _scan_files_loop(self):
-        while self._is_scanning:
-            was_requested = self._scan_requested_event.wait(timeout=0.1)
-            if was_requested is not True:
-                continue  # timeout reached
-
-            # scan was requested
-            self._scan_complete_event.clear()
-            self._scan_requested_event.clear()
-
-            is_suggestion_done = False
-
-            if self.text is not None:
-                text = str(self.text).strip()
-                cur_index = self.text_input_view.cur_index
+        """
+        called from the ui thread, so that the scan thread does not need
+        to read the text input view
+        """
+        text = self.text
+        if text is not None:
+            text = str(text)
+        self._request_scan(_ScanRequest(text, self.text_input_view.cur_index, CancelToken()))
+
+    def _rescan(self):
+        self._request_scan(self._scan_request._replace(token=CancelToken()))
+
+    def _request_scan(self, scan_request):
+        """
+        the token is created here and not in the scan, so that the scan
+        that is running is cancelled even if it has not started to glob
+        """
+        previous, self._scan_request = self._scan_request, scan_request
+        previous.token.cancel()
+        self.scheduler.request()
+
+    def _scan(self, generation):
+        if self.backend is None and self.manifest is not None:
+            # reading a large manifest takes a while, so it is not done
+            # in the ui thread
+            try:
+                self.backend = self.layout.app.scan_service.manifest_index(self.manifest)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                self._publish_backend_error(generation, e)
+                return
 
-                start_match = show_tag_suggestion_check.match(text[:cur_index])
-                if start_match is not None:
-                    tag_name = start_match.group("tag_name")
-                    newfilter = start_match.group("newfilter")
-                    if newfilter is None:
-                        newfilter = ""
+        scan_request = self._scan_request
+        token = scan_request.token
 
-                    self.tag_suggestions = list()
-                    for entity in self.entities:
-                        if not entity.startswith(tag_name):
-                            continue
+        is_suggestion_done = False
+        tag_suggestions: List[Text] = list()
 
-                        end_match = remove_tag_remainder_match.match(text[cur_index:])
+        if scan_request.text is not None:
+            text = scan_request.text.strip()
+            cur_index = scan_request.cur_index
 
-                        if len(newfilter) > 0:
-                            if end_match is not None:
-                                end_filter = end_match.group("oldtag")
-                                if end_filter is not None:
-                                    newfilter += end_filter[:-1]
+            start_match = show_tag_suggestion_check.match(text[:cur_index])
+            if start_match is not None:
+                tag_name = start_match.group("tag_name")
+                newfilter = start_match.group("newfilter")
+                if newfilter is None:
+                    newfilter = ""
 
-                        start = start_match.start("newtag")
-                        newtext = op.basename(text[:start])
+                for entity in self.entities:
+                    if not entity.startswith(tag_name):
+                        continue
 
-                        newtext += f"{{{entity}{newfilter}}}"
+                    end_match = remove_tag_remainder_match.match(text[cur_index:])
 
+                    if len(newfilter) > 0:
                         if end_match is not None:
-                            cur_index += end_match.end("oldtag")
+                            end_filter = end_match.group("oldtag")
+                            if end_filter is not None:
+                                newfilter += end_filter[:-1]
 
-                        newtext += text[cur_index:]
+                    start = start_match.start("newtag")
+                    newtext = op.basename(text[:start])
 
-                        self.tag_suggestions.append(
-                            self._tokenize(newtext, addBrackets=False)
-                        )
+                    newtext += f"{{{entity}{newfilter}}}"
 
-                    self._suggest_entities()
-                    is_suggestion_done = True
+                    if end_match is not None:
+                        cur_index += end_match.end("oldtag")
 
-            if self._scan_requested_event.is_set():
-                continue
+                    newtext += text[cur_index:]
 
-            if self.text is None or len(self.text) == 0:
-                pathname = op.join(os.curdir, "")
-            else:
-                pathname = str(self.text)
-                if not op.isabs(pathname):
-                    pathname = op.join(os.curdir, pathname)
-
-            newpathname = pathname + "{suggestion:.*}"
-            newpathname = resolve(newpathname)
-            tag_glob_generator = tag_glob(
-                newpathname, self.entities + ["suggestion"], self.dironly
-            )
+                    tag_suggestions.append(
+                        self._tokenize(newtext, addBrackets=False)
+                    )
 
-            new_suggestions = set()
-            suggestiontempl = op.basename(newpathname)
-            filepaths = []
-            tagdictlist = []
+                self._publish(
+                    self._snapshot._replace(
+                        generation=generation,
+                        is_complete=False,
+                        is_suggesting_entities=True,
+                        error=None,
+                        matching_files=(),
+                        tag_suggestions=tuple(tag_suggestions),
+                        options=tuple(sorted(tag_suggestions, key=attrgetter("value"))),
+                    )
+                )
+                is_suggestion_done = True
 
-            def _is_candidate(filepath):
-                if self.dironly is True:
-                    return op.isdir(filepath)
-                else:
-                    return op.isfile(filepath)
+        if not self.scheduler.is_current(generation):
+            return
 
+        if scan_request.text is None or len(scan_request.text) == 0:
+            pathname = op.join(os.curdir, "")
+        else:
+            pathname = scan_request.text
+            if not op.isabs(pathname):
+                pathname = op.join(os.curdir, pathname)
+
+        newpathname = pathname + "{suggestion:.*}"
+        newpathname = resolve(newpathname)
+
+        scan_root = op.dirname(newpathname)
+        while has_magic(scan_root):
+            scan_root = op.dirname(scan_root)
+        self._scan_root = scan_root
+
+        def _is_counted(record):
+            return len(record.tagdict.get("suggestion", "")) == 0 and self._is_candidate(record)
+
+        backend = self.backend
+        processes = self._processes
+
+        scan_cache = self._scan_cache
+        self._scan_cache = None
+        changed_dirs = self._take_changed_dirs()
+        if scan_cache is not None and len(changed_dirs) > 0:
+            updated_scan_cache = self._update_scan_cache(scan_cache, changed_dirs, token)
+            if token.cancelled:
+                # the next scan updates the cache instead
+                self._scan_cache = scan_cache
+                with self._changed_dirs_lock:
+                    self._changed_dirs.update(changed_dirs)
+                return
+            scan_cache = updated_scan_cache
+        is_refinement = scan_cache is not None and _is_refinement(scan_cache.pathname, pathname)
+        if is_refinement:
+            # the new pattern can only match paths that the previous
+            # one matched, so these are matched again in memory
+            backend = PathTree(scan_cache.paths)
+            processes = None
+
+        estimate = None
+        if self.estimate and not self.message_is_dirty and not is_refinement:
+            # sample the tree so that the user gets a count while the
+            # full scan is still running
             try:
-                for filepath, tagdict in tag_glob_generator:
-                    if "suggestion" in tagdict and len(tagdict["suggestion"]) > 0:
-                        suggestionstr = suggestion_match.sub(tagdict["suggestion"], suggestiontempl)
-                        if op.isdir(filepath):
-                            suggestionstr = op.join(suggestionstr, "")  # add trailing slash
-                        new_suggestions.add(suggestionstr)
-
-                    elif _is_candidate(filepath):
-                        filepaths.append(filepath)
-                        tagdictlist.append(tagdict)
-
-                    if self._scan_requested_event.is_set():
-                        break
-
-            except ValueError as e:
-                logger.debug("Error scanning files: %s", e, exc_info=True)
-                pass
-            except AssertionError as e:
-                logger.debug("Error scanning files: %s", e, exc_info=True)
+                estimate = estimate_tag_glob(
+                    newpathname,
+                    self.entities + ["suggestion"],
+                    self.dironly,
+                    where=_is_counted,
+                    backend=backend,
+                    token=token,
+                    deadline=monotonic() + estimate_timeout,
+                    exclude=self.exclude,
+                    tag_filters=self.tag_filters,
+                )
+            except UnsafeFilterError as e:
+                self._publish_filter_error(generation, e)
                 return
+            except (OSError, sqlite3.Error) as e:
+                self._publish_backend_error(generation, e)
+                return
+            if estimate is not None and estimate.matches == 0:
+                estimate = None
+            if estimate is not None:
+                message = self._estimate_message(0, estimate)
+                if message is not None:
+                    self._publish(
+                        self._snapshot._replace(
+                            generation=generation,
+                            message=message,
+                            is_complete=False,
+                            error=None,
+                        )
+                    )
 
-            if self._scan_requested_event.is_set():
-                continue
-
-            tagsetdict = {}
-            if len(tagdictlist) > 0:
-                tagsetdict = {
-                    k: set(dic[k] for dic in tagdictlist) for k in tagdictlist[0] if k != "suggestion"
-                }
-
-            nfile = len(filepaths)
-
-            has_all_required_entities = all(entity in tagsetdict for entity in self.required_entities)
-            logger.debug(f"has_all_required_entities={has_all_required_entities}")
-
-            if not self.message_is_dirty:
-                value = self.message.value
-                color = self.message.color
-
-                if nfile == 0:
-                    value = ""
-
-                elif has_all_required_entities:
-                    color = self.layout.color.iblue
-                    value = p.inflect(f"Found {nfile} plural('file', {nfile})")
-
-                    if len(tagsetdict) > 0:
-                        value += " "
-                        value += "for"
-                        value += " "
-                        tagmessages = [
-                            p.inflect(f"{len(v)} plural('{k}', {len(v)})")
-                            for k, v in tagsetdict.items()
-                        ]
-                        value += p.join(tagmessages)
+        tag_glob_generator = tag_glob(
+            newpathname,
+            self.entities + ["suggestion"],
+            self.dironly,
+            backend=backend,
+            token=token,
+            records=True,
+            processes=processes,
+            exclude=self.exclude,
+            tag_filters=self.tag_filters,
+        )
 
-                else:
-                    color = self.layout.color.iyellow
-                    value = "Missing"
-                    value += " "
-                    value += p.join(
-                        [
-                            f"{{{entity}}}"
-                            for entity in self.required_entities
-                            if entity not in tagsetdict
-                        ]
+        new_suggestions = set()
+        suggestion_list: List[str] = list()
+        matching_files: List[Text] = list()
+        suggestiontempl = op.basename(newpathname)
+        columns = TagColumns()
+        scanned_paths: Optional[List[str]] = list()
+
+        def _tokenize_suggestions():
+            for s in suggestion_list[len(matching_files) :]:
+                matching_files.append(self._tokenize(s, addBrackets=False))
+
+        publish_time = monotonic()
+        npublished = 0
+        refine_time = publish_time
+        try:
+            for record in tag_glob_generator:
+                tagdict = record.tagdict
+                if "suggestion" in tagdict and len(tagdict["suggestion"]) > 0:
+                    suggestionstr = suggestion_match.sub(tagdict["suggestion"], suggestiontempl)
+                    if record.is_dir:
+                        suggestionstr = op.join(suggestionstr, "")  # add trailing slash
+                    if suggestionstr not in new_suggestions:
+                        new_suggestions.add(suggestionstr)
+                        suggestion_list.append(suggestionstr)
+                    scanned_paths.append(record.path)
+
+                elif self._is_candidate(record):
+                    columns.append(record.path, tagdict)
+                    scanned_paths.append(record.path)
+
+                nresult = len(columns) + len(suggestion_list)
+                if nresult - npublished >= publish_batch or (
+                    nresult > npublished and monotonic() - publish_time > publish_interval
+                ):
+                    # show partial results while the scan is running
+                    message = None
+                    if monotonic() - refine_time > refine_interval:
+                        message = self._progress_message(columns, estimate)
+                        refine_time = monotonic()
+                    snapshot = self._snapshot._replace(
+                        generation=generation,
+                        message=message,
+                        is_complete=False,
+                        error=None,
                     )
-                self.message = TextElement(value, color)
-
-            self.message_is_dirty = False
+                    if not is_suggestion_done and len(suggestion_list) > len(matching_files):
+                        _tokenize_suggestions()
+                        snapshot = snapshot._replace(
+                            is_suggesting_entities=False,
+                            matching_files=tuple(matching_files),
+                            tag_suggestions=(),
+                            options=tuple(sorted(matching_files, key=attrgetter("value"))),
+                        )
+                    self._publish(snapshot)
+                    publish_time = monotonic()
+                    npublished = nresult
+
+        except UnsafeFilterError as e:
+            self._publish_filter_error(generation, e)
+            return
+        except (OSError, sqlite3.Error) as e:
+            self._publish_backend_error(generation, e)
+            return
+        except ValueError as e:
+            logger.debug("Error scanning files: %s", e, exc_info=True)
+            scanned_paths = None
+        except AssertionError as e:
+            logger.debug("Error scanning files: %s", e, exc_info=True)
+            return
+
+        if scanned_paths is not None and not token.cancelled:
+            # also when a newer request has arrived, which does not cancel
+            # the scan if the files have changed
+            self._scan_cache = _ScanCache(pathname, scanned_paths)
+
+        if not self.scheduler.is_current(generation):
+            return
+
+        nvaluedict = columns.nunique()
+        nvaluedict.pop("suggestion", None)
+
+        nfile = len(columns)
+
+        has_all_required_entities = all(entity in nvaluedict for entity in self.required_entities)
+        logger.debug(f"has_all_required_entities={has_all_required_entities}")
+
+        message = None
+        if not self.message_is_dirty:
+            value = ""
+            color = self.layout.color.default
+
+            if nfile == 0:
+                value = ""
+
+            elif has_all_required_entities:
+                color = self.layout.color.iblue
+                value = p.inflect(f"Found {nfile} plural('file', {nfile})")
+                value += self._tag_message(nvaluedict)
 
-            if nfile > 0 and has_all_required_entities:
-                self.is_ok = True
             else:
-                self.is_ok = False
+                color = self.layout.color.iyellow
+                value = "Missing"
+                value += " "
+                value += p.join(
+                    [
+                        f"{{{entity}}}"
+                        for entity in self.required_entities
+                        if entity not in nvaluedict
+                    ]
+                )
+            message = TextElement(value, color)
+
+        is_ok = nfile > 0 and has_all_required_entities
+
+        snapshot = self._snapshot._replace(
+            generation=generation,
+            message=message,
+            is_ok=is_ok,
+            is_complete=True,
+            error=None,
+        )
+        if not is_suggestion_done:
+            _tokenize_suggestions()
+            snapshot = snapshot._replace(
+                is_suggesting_entities=False,
+                matching_files=tuple(matching_files),
+                tag_suggestions=(),
+                options=tuple(sorted(matching_files, key=attrgetter("value"))),
+            )
+        self._publish(snapshot)
 
-            if not is_suggestion_done:
-                self.matching_files = [
-                    self._tokenize(s, addBrackets=False)
-                    for s in new_suggestions
-                ]
-                self._suggest_matches()
+    def _is_scan_complete(self, snapshot: Optional[_ScanSnapshot]) -> bool:
+        return (
+            snapshot is not None
+            and snapshot.is_complete
+            and self.scheduler.is_current(snapshot.generation)
+        )
 
     def _handleKey(self, c):
+        # suggestions are only used once the scan of the current text is
+        # complete, as they are from older text before, and are re-sorted
+        # while the results come in. the snapshot is applied in the app
+        # thread, so the view is not changed here
+        snapshot = self._applied_snapshot
+        is_scan_complete = self._is_scan_complete(snapshot)
+
         cur_text = str(self.text)
         cur_index = self.text_input_view.cur_index
 
@@ -373,10 +848,11 @@ class FilePatternInputView(CallableView):
         def _enter_suggestion_view():
             nonlocal needs_update
 
-            if not self._scan_complete_event.is_set():
+            if not is_scan_complete:
                 return
 
-            if self.is_suggesting_entities or len(self.matching_files) > 0:
+            assert snapshot is not None
+            if snapshot.is_suggesting_entities or len(snapshot.matching_files) > 0:
                 self.suggestion_view.isActive = True
                 self.text_input_view.isActive = False
                 self.suggestion_view._before_call()
@@ -393,7 +869,7 @@ class FilePatternInputView(CallableView):
             needs_update = True
 
         def _apply_suggestion(selection: str):
-            if not self._scan_complete_event.is_set():
+            if not is_scan_complete:
                 return
 
             cur_index = self.text_input_view.cur_index
@@ -409,7 +885,6 @@ class FilePatternInputView(CallableView):
 
         if c == Key.Break:
             self.text = None
-            self.suggestion_view.set_options([])
             self.isActive = False
 
         elif self.suggestion_view.isActive and self.suggestion_view.cur_index is not None:
@@ -435,13 +910,13 @@ class FilePatternInputView(CallableView):
                 _enter_suggestion_view()
 
             elif c == Key.Tab:
-                tab_completion_candidates = []
-                if self.is_suggesting_entities:
-                    if isinstance(self.tag_suggestions, list):
-                        tab_completion_candidates = self.tag_suggestions
+                tab_completion_candidates: List[Text] = []
+                if not is_scan_complete:
+                    pass
+                elif snapshot.is_suggesting_entities:
+                    tab_completion_candidates = list(snapshot.tag_suggestions)
                 else:
-                    if isinstance(self.matching_files, list):
-                        tab_completion_candidates = self.matching_files
+                    tab_completion_candidates = list(snapshot.matching_files)
 
                 if len(tab_completion_candidates) > 0:
                     cc = common_chars(tab_completion_candidates)
@@ -453,8 +928,7 @@ class FilePatternInputView(CallableView):
                             self.tab_pressed = True
 
             elif c == Key.Return:
-                if self._is_ok() and self._scan_complete_event.is_set():
-                    self.suggestion_view.set_options([])
+                if self._is_ok():
                     self.suggestion_view.isActive = False
                     self.text_input_view.isActive = False
                     self.isActive = False
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+answer directory listings from a find-style manifest of paths instead
+of the file system
+"""
+from typing import Dict, Generator, Optional, Tuple
+
+import os
+from os import path as op
+import bz2
+import errno
+import gzip
+import lzma
+import mmap
+
+import numpy as np
+
+from .dircache import DirEntryInfo, dircache
+
+_decompressors = [
+    (b"\x1f\x8b", gzip.decompress),
+    (b"BZh", bz2.decompress),
+    (b"\xfd7zXZ\x00", lzma.decompress),
+]
+
+# the indices that were unpickled in this process, so that a worker
+# process reads a manifest once and not for every task that it is sent
+_unpickled: Dict[Tuple[str, str], Tuple[int, "ManifestIndex"]] = dict()
+
+
+def _read(manifest):
+    """
+    memory-map the manifest, or decompress it into memory
+    """
+    with open(manifest, "rb") as file_handle:
+        if os.fstat(file_handle.fileno()).st_size == 0:
+            return b""
+        buf = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    for magic, decompress in _decompressors:
+        if buf[: len(magic)] == magic:
+            try:
+                data = decompress(buf)
+            except (EOFError, lzma.LZMAError) as e:  # truncated or corrupt
+                raise ValueError(f"Cannot decompress manifest {manifest}: {e}") from e
+            finally:
+                buf.close()
+            return data
+    return buf
+
+
+def _split(buf, sep) -> Generator[bytes, None, None]:
+    start = 0
+    while start < len(buf):
+        end = buf.find(sep, start)
+        if end < 0:
+            end = len(buf)
+        yield buf[start:end]
+        start = end + 1
+
+
+class ManifestIndex:
+    """
+    the manifest lists one path per line, or per NUL byte, and may be
+    compressed with gzip, bzip2 or xz. relative paths are relative to
+    root, which defaults to the directory of the manifest. directories
+    are recognized by the paths below them, or by a trailing slash
+
+    the paths are kept sorted in a single buffer, so that a listing is a
+    range query over the paths with the directory as their prefix.
+    directories outside of the paths in the manifest are listed through
+    the shared directory cache
+    """
+
+    def __init__(self, manifest, root=None):
+        self.manifest = manifest
+        self.mtime_ns = os.stat(manifest).st_mtime_ns
+        if root is None:
+            root = op.dirname(op.abspath(manifest))
+        self.root = op.normpath(op.abspath(root))
+
+        buf = _read(manifest)
+        sep = b"\0" if buf.find(b"\0", 0, 1 << 16) >= 0 else b"\n"
+
+        encoded_root = os.fsencode(op.join(self.root, ""))
+        paths = set()
+        for path in _split(buf, sep):
+            path = path.rstrip(b"\r")
+            if len(path) == 0:
+                continue
+            if not path.startswith(b"/"):
+                if path.startswith(b"./"):
+                    path = path[2:]
+                path = encoded_root + path
+            paths.add(path)
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+        sorted_paths = sorted(paths)
+        del paths
+
+        lengths = np.fromiter(map(len, sorted_paths), dtype=np.int64, count=len(sorted_paths))
+        self._offsets = np.zeros(len(sorted_paths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self._offsets[1:])
+        self._buffer = b"".join(sorted_paths)
+
+        self.prefix = b""
+        if len(sorted_paths) > 0:
+            first, last = os.fsdecode(sorted_paths[0]), os.fsdecode(sorted_paths[-1])
+            self.prefix = os.fsencode(op.join(op.commonpath([first, last]), ""))
+
+    def __reduce__(self):
+        return (_unpickle, (self.manifest, self.root, self.mtime_ns))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _path(self, i) -> bytes:
+        return self._buffer[self._offsets[i] : self._offsets[i + 1]]
+
+    def _lower_bound(self, key, lo=0, hi=None) -> int:
+        if hi is None:
+            hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, prefix) -> Tuple[int, int]:
+        """
+        the paths that start with prefix, which ends with a slash
+        """
+        lo = self._lower_bound(prefix)
+        hi = self._lower_bound(prefix[:-1] + b"0", lo)  # "0" sorts right after "/"
+        return lo, hi
+
+    def listdir(self, path) -> Tuple[DirEntryInfo, ...]:
+        """
+        same interface as DirectoryCache.listdir
+        """
+        if not path:
+            path = os.curdir
+        key = op.normpath(op.abspath(path))
+        prefix = os.fsencode(op.join(key, ""))
+
+        if not prefix.startswith(self.prefix):
+            return dircache.listdir(key)
+
+        lo, hi = self._range(prefix)
+        if lo == hi:
+            raise FileNotFoundError(errno.ENOENT, "Not in manifest", key)
+
+        is_dir_by_name = dict()
+        i = lo
+        while i < hi:
+            rest = self._path(i)[len(prefix) :]
+            name, slash, _ = rest.partition(b"/")
+            if len(name) == 0:  # the directory itself
+                i += 1
+            elif len(slash) > 0:
+                is_dir_by_name[name] = True
+                i = self._lower_bound(prefix + name + b"0", i, hi)  # skip the subtree
+            else:
+                is_dir_by_name.setdefault(name, False)
+                i += 1
+
+        return tuple(
+            DirEntryInfo(os.fsdecode(name), is_dir, not is_dir, False)
+            for name, is_dir in is_dir_by_name.items()
+        )
+
+    def identity(self, path) -> Optional[Tuple[int, int]]:
+        """
+        manifests have no symlinks, so no cycles need to be detected
+        """
+        key = op.normpath(op.abspath(path or os.curdir))
+        if not os.fsencode(op.join(key, "")).startswith(self.prefix):
+            return dircache.identity(key)
+        return None
+
+    def missing(self) -> Generator[str, None, None]:
+        """
+        yields the paths in the manifest that no longer exist. this stats
+        every path, so it is only done when asked for
+        """
+        for i in range(len(self)):
+            path = os.fsdecode(self._path(i).rstrip(b"/"))
+            if not op.lexists(path):
+                yield path
+
+
+def _unpickle(manifest, root, mtime_ns) -> ManifestIndex:
+    """
+    reuses the index that was read before, unless the manifest has
+    changed since
+    """
+    key = (manifest, root)
+    cached = _unpickled.get(key)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    index = ManifestIndex(manifest, root)
+    _unpickled[key] = (mtime_ns, index)
+    return index
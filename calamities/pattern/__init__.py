@@ -3,24 +3,62 @@ from .re import (
     tokenize,
     magic_check,
     special_match,
+    glob_magic_split,
     chartype_filter,
     suggestion_match,
     show_tag_suggestion_check,
     remove_tag_remainder_match,
+    range_filter_match,
+)
+from .columnar import TagColumns
+from .tagfilter import TagFilter
+from .safety import UnsafeFilterError, check_regex
+from .aio import atag_glob
+from .estimate import estimate_tag_glob, GlobEstimate
+from .match import tag_match
+from .glob import (
+    tag_glob,
+    tag_glob_columns,
+    tag_glob_many,
+    has_magic,
+    get_entities_in_path,
+    ScanStats,
+    GlobRecord,
+    CancelToken,
+    GlobProcessPool,
+    translate_cache_info,
+    translate_cache_clear,
 )
-from .glob import tag_glob, has_magic, get_entities_in_path
 
 __all__ = [
     "tag_parse",
     "tokenize",
     "magic_check",
     "special_match",
+    "glob_magic_split",
     "chartype_filter",
     "tokenize",
     "suggestion_match",
     "show_tag_suggestion_check",
     "remove_tag_remainder_match",
+    "range_filter_match",
     "tag_glob",
+    "tag_glob_columns",
+    "TagColumns",
+    "TagFilter",
+    "UnsafeFilterError",
+    "check_regex",
+    "tag_glob_many",
+    "tag_match",
+    "atag_glob",
+    "estimate_tag_glob",
+    "GlobEstimate",
     "has_magic",
     "get_entities_in_path",
+    "ScanStats",
+    "GlobRecord",
+    "CancelToken",
+    "GlobProcessPool",
+    "translate_cache_info",
+    "translate_cache_clear",
 ]
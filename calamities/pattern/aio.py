@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Lock
+
+from .glob import tag_glob, CancelToken
+
+default_max_workers = 4
+
+_default_executor: Optional[Executor] = None
+_default_executor_lock = Lock()
+
+
+def _get_default_executor() -> Executor:
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(
+                max_workers=default_max_workers, thread_name_prefix="atag_glob"
+            )
+        return _default_executor
+
+
+def _next_batch(generator, batch_size) -> List:
+    batch = list()
+    for item in generator:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            break
+    return batch
+
+
+async def atag_glob(
+    pathname, entities=None, dironly=False, executor=None, batch_size=256, **kwargs
+) -> AsyncGenerator[Tuple[str, Dict], None]:
+    """
+    async variant of tag_glob. the traversal runs in batches on an
+    executor, which bounds the number of concurrent scans and defaults
+    to a small shared thread pool. at most one batch is computed ahead
+    of the consumer, and cancelling the consuming task stops the scan
+    """
+    if executor is None:
+        executor = _get_default_executor()
+
+    token = CancelToken(kwargs.pop("token", None))
+    generator = tag_glob(pathname, entities, dironly, token=token, **kwargs)
+
+    future = executor.submit(_next_batch, generator, batch_size)
+    try:
+        while future is not None:
+            batch = await asyncio.wrap_future(future)
+
+            if len(batch) < batch_size:  # generator is exhausted
+                future = None
+            else:
+                future = executor.submit(_next_batch, generator, batch_size)
+
+            for item in batch:
+                yield item
+    finally:
+        token.cancel()
+        if future is not None:
+            future.cancel()
+            future.add_done_callback(lambda _: generator.close())
+        else:
+            generator.close()
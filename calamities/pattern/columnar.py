@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from typing import Dict, List, Mapping, Tuple
+
+from array import array
+
+import numpy as np
+
+
+class TagColumns:
+    """
+    collects tag_glob results column by column. the values of every
+    entity are category-encoded as integer codes into a list of unique
+    values, with -1 for files that do not have the entity
+    """
+
+    def __init__(self):
+        self.paths: List[str] = list()
+
+        self._codes: Dict[str, array] = dict()
+        self._code_by_value: Dict[str, Dict[str, int]] = dict()
+        self._values: Dict[str, List[str]] = dict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def entities(self) -> List[str]:
+        return list(self._codes.keys())
+
+    def append(self, path, *tagdicts: Mapping[str, str]):
+        """
+        tagdicts are merged in order, for example the tags of the parent
+        directory followed by the tags of the basename
+        """
+        row = len(self.paths)
+        self.paths.append(path)
+
+        for tagdict in tagdicts:
+            for entity, value in tagdict.items():
+                codes = self._codes.get(entity)
+                if codes is None:
+                    codes = array("l", [-1]) * row
+                    self._codes[entity] = codes
+                    self._code_by_value[entity] = dict()
+                    self._values[entity] = list()
+
+                code_by_value = self._code_by_value[entity]
+                code = code_by_value.get(value)
+                if code is None:
+                    code = len(code_by_value)
+                    code_by_value[value] = code
+                    self._values[entity].append(value)
+
+                if len(codes) > row:  # repeated entity
+                    codes[row] = code
+                else:
+                    codes.append(code)
+
+        for codes in self._codes.values():
+            if len(codes) == row:
+                codes.append(-1)
+
+    def extend(self, results):
+        for path, tagdict in results:
+            self.append(path, tagdict)
+
+    def codes(self, entity) -> np.ndarray:
+        return np.array(self._codes[entity], dtype=np.int64)  # copy, so that appending still works
+
+    def values(self, entity) -> np.ndarray:
+        return np.array(self._values[entity], dtype=object)
+
+    def column(self, entity) -> np.ndarray:
+        """
+        the value of the entity for every file, or None where it is missing
+        """
+        codes = self.codes(entity)
+        values = np.append(self.values(entity), None)
+        return values[codes]  # code -1 selects the trailing None
+
+    def value_counts(self, entity) -> Tuple[np.ndarray, np.ndarray]:
+        codes = self.codes(entity)
+        counts = np.bincount(codes[codes >= 0], minlength=len(self._values[entity]))
+        present = counts > 0
+        return self.values(entity)[present], counts[present]
+
+    def nunique(self) -> Dict[str, int]:
+        """
+        number of distinct values of every entity that was found
+        """
+        res = dict()
+        for entity in self._codes.keys():
+            codes = self.codes(entity)
+            counts = np.bincount(codes[codes >= 0], minlength=len(self._values[entity]))
+            nvalue = int(np.count_nonzero(counts))
+            if nvalue > 0:
+                res[entity] = nvalue
+        return res
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+estimate the number of matches of a pattern from a random sample of the
+matching directories, for trees that are too large to scan while the
+user is typing
+"""
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import math
+import random
+from os import path as op
+
+from .glob import (
+    GlobRecord,
+    _combine_tagdict,
+    _compile_tree,
+    _glob_context,
+    _iterdir,
+    _list_for_walk,
+    _make_record,
+    _match_names,
+)
+
+default_max_depth = 16
+
+
+class GlobEstimate(NamedTuple):
+    matches: float
+    stderr: float
+    nunique: Dict[str, int]
+    exact: bool
+
+    @property
+    def relative_error(self) -> float:
+        """
+        standard error as a fraction of the estimate
+        """
+        if self.matches <= 0:
+            return 0.0 if self.stderr == 0 else math.inf
+        return self.stderr / self.matches
+
+
+def estimate_tag_glob(
+    pathname,
+    entities=None,
+    dironly=False,
+    samples=8,
+    where: Optional[Callable[[GlobRecord], bool]] = None,
+    seed=None,
+    backend=None,
+    token=None,
+    deadline=None,
+    max_depth=None,
+    follow_symlinks=True,
+    exclude=None,
+    tag_filters=None,
+) -> Optional[GlobEstimate]:
+    """
+    at every magic level, all matching directories are walked if there
+    are at most samples of them. otherwise a random sample is walked and
+    its counts are scaled up. below a sampled level, the number of
+    samples halves with every level, but does not drop below two
+
+    only the matches for which where returns True are counted. nunique
+    is the number of distinct values of each tag that a counted match
+    has. at a sampled level, it is scaled up by the share of the sampled
+    values that had a match
+
+    returns None if the token is cancelled or the deadline passes first
+    """
+    with _glob_context(
+        backend=backend,
+        token=token,
+        deadline=deadline,
+        max_depth=max_depth,
+        follow_symlinks=follow_symlinks,
+        exclude=exclude,
+        tag_filters=tag_filters,
+    ) as ctx:
+        estimator = _Estimator(ctx, dironly, where, random.Random(seed))
+        total, variance = 0.0, 0.0
+        for root, node in _compile_tree([pathname], entities, tag_filters=ctx.tag_filters).items():
+            t, v = estimator.walk(root, dict(), node, samples)
+            total += t
+            variance += v
+        return GlobEstimate(total, math.sqrt(variance), estimator.nunique(), not estimator.sampled)
+    return None
+
+
+class _Estimator:
+    def __init__(self, ctx, dironly, where, rng):
+        self.ctx = ctx
+        self.dironly = dironly
+        self.where = where
+        self.rng = rng
+
+        self.values: Dict[str, Set[str]] = dict()
+        self.scaled: Dict[str, float] = dict()
+        self.sampled = False
+
+    def observe(self, tagdict):
+        for tag_name, value in tagdict.items():
+            self.values.setdefault(tag_name, set()).add(_strip(value))
+
+    def nunique(self) -> Dict[str, int]:
+        nunique = {tag_name: len(values) for tag_name, values in self.values.items()}
+        for tag_name, n in self.scaled.items():
+            n = max(nunique.get(tag_name, 0), round(n))
+            if n > 0:
+                nunique[tag_name] = n
+        return nunique
+
+    def scale(self, subdirs: List, sampled: List, results: List[Tuple[float, float]]):
+        """
+        the values of a tag that have a match are the values of all the
+        directories, times the share of the sampled values that had one
+        """
+        tag_names: Set[str] = set()
+        for _, tagdict, _ in subdirs:
+            tag_names.update(tagdict.keys())
+        for tag_name in tag_names:
+            values = {
+                _strip(tagdict[tag_name]) for _, tagdict, _ in subdirs if tag_name in tagdict
+            }
+            sampled_values, matched_values = set(), set()
+            for (_, tagdict, _), (t, _) in zip(sampled, results):
+                if tag_name not in tagdict:
+                    continue
+                value = _strip(tagdict[tag_name])
+                sampled_values.add(value)
+                if t > 0:
+                    matched_values.add(value)
+            if len(sampled_values) == 0:
+                continue
+            n = len(values) * len(matched_values) / len(sampled_values)
+            self.scaled[tag_name] = max(self.scaled.get(tag_name, 0.0), n)
+
+    def count(self, path, dirtagdict, tagdict, entry) -> int:
+        tagdict = _combine_tagdict(dirtagdict, tagdict)
+        if self.where is not None:
+            if not self.where(_make_record(path, tagdict, entry, False)):
+                return 0
+        self.observe(tagdict)
+        return 1
+
+    def walk(self, dirname, dirtagdict, node, nsample) -> Tuple[float, float]:
+        """
+        returns the estimated number of matches and its variance
+        """
+        total, variance = 0.0, 0.0
+
+        matched_children = list()
+        for component, child in node.children.items():
+            if child.recursive:
+                t, v = self.walk_recursive(dirname, dirtagdict, child, nsample, 0, set())
+            elif child.match is None:
+                t, v = self.walk(op.join(dirname, component, ""), dirtagdict, child, nsample)
+            else:
+                matched_children.append(child)
+                continue
+            total += t
+            variance += v
+
+        if len(matched_children) == 0:
+            return total, variance
+
+        names = _list_for_walk(dirname, node, self.dironly, self.ctx)
+
+        for child in matched_children:
+            subdirs = list()
+            for name, tagdict, entry in _match_names(names, child.match, dirtagdict, self.ctx):
+                path = op.join(dirname, name)
+                is_dir = name.endswith("/")
+                if len(child.indices) > 0 and (not self.dironly or is_dir):
+                    total += self.count(path, dirtagdict, tagdict, entry)
+                if is_dir and len(child.children) > 0:
+                    subdirs.append((path, _combine_tagdict(dirtagdict, tagdict), child))
+            t, v = self.sample(subdirs, nsample, self.walk)
+            total += t
+            variance += v
+
+        return total, variance
+
+    def walk_recursive(
+        self, dirname, dirtagdict, node, nsample, depth, seen
+    ) -> Tuple[float, float]:
+        """
+        like _rlistdir, directories that were already visited are in seen
+        """
+        total, variance = 0.0, 0.0
+
+        follow_symlinks = self.ctx.follow_symlinks
+        if depth == 0 and follow_symlinks:
+            seen.add(self.ctx.backend.identity(dirname))
+
+        if dirname:  # zero directories
+            path = op.join(dirname, "")
+            if len(node.indices) > 0:
+                total += self.count(path, dirtagdict, dict(), None)
+            if len(node.children) > 0:
+                t, v = self.walk(path, dirtagdict, node, nsample)
+                total += t
+                variance += v
+
+        max_depth = self.ctx.max_depth
+        if max_depth is None:
+            max_depth = default_max_depth
+        if depth >= max_depth:
+            return total, variance
+
+        needs_files = not self.dironly and len(node.indices) > 0
+        subdirs = list()
+        for name, entry in _iterdir(dirname, not needs_files, self.ctx):
+            path = op.join(dirname, name)
+            if not entry.is_dir:
+                total += self.count(path, dirtagdict, dict(), entry)
+                continue
+            if entry.is_symlink and not follow_symlinks:
+                continue
+            if follow_symlinks:
+                identity = self.ctx.backend.identity(path)
+                if identity is not None:
+                    if identity in seen:
+                        continue
+                    seen.add(identity)
+            subdirs.append((path, dirtagdict, node))
+
+        def _walk_recursive(path, tagdict, node, nsample):
+            return self.walk_recursive(path, tagdict, node, nsample, depth + 1, seen)
+
+        t, v = self.sample(subdirs, nsample, _walk_recursive)
+        return total + t, variance + v
+
+    def sample(self, subdirs: List, nsample, walk) -> Tuple[float, float]:
+        n = len(subdirs)
+        if n == 0:
+            return 0.0, 0.0
+
+        if n <= nsample:  # no need to sample
+            total, variance = 0.0, 0.0
+            for path, tagdict, node in subdirs:
+                t, v = walk(path, tagdict, node, nsample)
+                total += t
+                variance += v
+            return total, variance
+
+        self.sampled = True
+        k = nsample
+        sampled = self.rng.sample(subdirs, k)
+        results = [
+            walk(path, tagdict, node, max(2, nsample // 2)) for path, tagdict, node in sampled
+        ]
+        self.scale(subdirs, sampled, results)
+
+        # two-stage sampling without replacement
+        mean = sum(t for t, _ in results) / k
+        if k > 1:
+            s2 = sum((t - mean) ** 2 for t, _ in results) / (k - 1)
+        else:
+            s2 = math.inf
+        variance = n * n * (1 - k / n) * s2 / k + n / k * sum(v for _, v in results)
+        return n * mean, variance
+
+
+def _strip(value) -> str:
+    if value.endswith("/"):
+        return value[:-1]
+    return value
@@ -2,44 +2,748 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
-from typing import Dict, Generator, Tuple
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import os
 from os import path as op
 
 import re
+import pickle
 import fnmatch
+import itertools
+from functools import lru_cache
+from collections import deque
+from queue import Empty
+from concurrent.futures import (
+    Executor,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    Future,
+    wait,
+    FIRST_COMPLETED,
+)
+from multiprocessing import get_context
+from threading import Event, Lock
+from time import monotonic
+from contextlib import contextmanager
 
+from ..dircache import dircache
+from ..exclude import exclude_rules
+from .columnar import TagColumns
+from .tagfilter import TagFilter
+from .safety import UnsafeFilterError, check_regex, compile_fullmatch
 from .re import (
     tag_parse,
     tokenize,
     magic_check,
     special_match,
+    glob_magic_split,
 )
 
+translate_cache_size = 4096
+
+# a worker process sends the results of a shard back once it has this
+# many, or once this many seconds have passed since it last sent any
+shard_chunk_size = 256
+shard_chunk_interval = 0.05
+
 
-def tag_glob(pathname, entities=None, dironly=False) -> Generator[Tuple[str, Dict], None, None]:
+def tag_glob(
+    pathname,
+    entities=None,
+    dironly=False,
+    max_workers=None,
+    ordered=True,
+    stats=None,
+    backend=None,
+    token=None,
+    deadline=None,
+    max_results=None,
+    records=False,
+    stat=False,
+    max_depth=None,
+    follow_symlinks=True,
+    processes=None,
+    exclude=None,
+    tag_filters=None,
+) -> Generator[Union[Tuple[str, Dict], "GlobRecord"], None, None]:
     """
     adapted from cpython glob
+
+    with max_workers > 1, sibling directories are listed and matched
+    concurrently by a bounded thread pool. results are yielded in the
+    same order as the sequential traversal unless ordered is False
+
+    pass a ScanStats object as stats to collect traversal counters
+
+    directories are listed through backend.listdir, which defaults to the
+    shared directory cache and can be replaced by a FileIndex
+
+    the scan stops early once token is cancelled, once time.monotonic()
+    passes deadline or after max_results results. these are checked for
+    every directory entry, so a stale scan does not run on until its next
+    match. the reason is recorded in stats.stopped
+
+    with records, GlobRecord objects are yielded instead of tuples. their
+    file type comes from the directory listing, so no further stat calls
+    are needed. size and mtime are only filled in with stat
+
+    a ** component matches zero or more directories. it descends at most
+    max_depth levels, and into symlinked directories only with
+    follow_symlinks. directories that were already visited are skipped,
+    so symlink cycles terminate
+
+    processes can be a number of worker processes, a GlobProcessPool or
+    a process pool executor. the directories matched by the first magic
+    directory component are then matched in the workers, each of which
+    lists and matches its own subtree, so that matching does not compete
+    for the GIL with the calling process. with a GlobProcessPool, the
+    workers send their results while they scan and stop once the scan
+    is stopped. other executors send the results of a subtree once it
+    has been scanned. the exclude rules and tag filters are pickled for
+    the workers, so predicates need to be functions that the workers can
+    import. lambdas and nested functions raise ValueError
+
+    entries that match the exclude rules are skipped without being
+    listed. exclude defaults to Config.exclude
+
+    tag_filters maps tag names to the values that they may take, as a
+    collection of values, a range of numbers, a predicate or a TagFilter.
+    in the pattern, {tag=01..50} is a range and {tag=a,b,c} is a set of
+    values. a name is checked against these before the regex is run
     """
-    dirname, basename = op.split(pathname)
-    if not dirname:
-        # print(repr(dirname), repr(basename))
-        if _isrecursive(basename):
-            dir_generator = _rlistdir(dirname, dironly)
-        else:
-            dir_generator = _iterdir(dirname, dironly)
-        for dirname in dir_generator:
-            yield (dirname, dict())
+    if processes is not None:
+        yield from _tag_glob_processes(
+            pathname,
+            entities,
+            dironly,
+            processes,
+            ordered,
+            stats,
+            backend,
+            token,
+            deadline,
+            max_results,
+            records,
+            stat,
+            max_depth,
+            follow_symlinks,
+            exclude,
+            tag_filters,
+        )
         return
-    if dirname != pathname and has_magic(dirname):
-        dirs = tag_glob(dirname, entities, dironly=True)
+
+    with _glob_context(
+        max_workers,
+        ordered,
+        stats,
+        backend,
+        token,
+        deadline,
+        max_depth,
+        follow_symlinks,
+        exclude=exclude,
+        tag_filters=tag_filters,
+    ) as ctx:
+        results = _tag_glob_parts(pathname, entities, dironly, ctx)
+        for path, dirtagdict, tagdict, entry in _limit(results, max_results, ctx):
+            tagdict = _combine_tagdict(dirtagdict, tagdict)
+            if records:
+                yield _make_record(path, tagdict, entry, stat)
+            else:
+                yield (path, tagdict)
+
+
+class GlobRecord(NamedTuple):
+    path: str
+    tagdict: Dict
+    is_dir: bool
+    is_file: bool
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+
+
+def _make_record(path, tagdict, entry, stat) -> GlobRecord:
+    if entry is not None:
+        is_dir, is_file = entry.is_dir, entry.is_file
     else:
-        dirs = [(dirname, dict())]
-    for dirname, dirtagdict in dirs:
-        # print("40", repr(dirname), repr(dirtagdict))
-        for name, tagdict in _tag_glob_in_dir(dirname, basename, entities, dironly, dirtagdict):
-            yield (op.join(dirname, name), _combine_tagdict(dirtagdict, tagdict))
+        is_dir, is_file = op.isdir(path), op.isfile(path)
+    if not stat:
+        return GlobRecord(path, tagdict, is_dir, is_file)
+    try:
+        st = os.stat(path)
+        return GlobRecord(path, tagdict, is_dir, is_file, st.st_size, st.st_mtime)
+    except OSError:
+        return GlobRecord(path, tagdict, is_dir, is_file)
+
+
+def tag_glob_columns(
+    pathname,
+    entities=None,
+    dironly=False,
+    max_workers=None,
+    ordered=True,
+    stats=None,
+    backend=None,
+    token=None,
+    deadline=None,
+    max_results=None,
+    exclude=None,
+    tag_filters=None,
+) -> TagColumns:
+    """
+    like tag_glob, but collect the results into a TagColumns object
+    without building a tagdict for every file
+    """
+    columns = TagColumns()
+    with _glob_context(
+        max_workers,
+        ordered,
+        stats,
+        backend,
+        token,
+        deadline,
+        exclude=exclude,
+        tag_filters=tag_filters,
+    ) as ctx:
+        results = _limit(_tag_glob_parts(pathname, entities, dironly, ctx), max_results, ctx)
+        for path, dirtagdict, tagdict, _ in results:
+            columns.append(path, dirtagdict, tagdict)
+    return columns
+
+
+class CancelToken:
+    """
+    cancels the scans that it was passed to. a token is also cancelled
+    when its parent is
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._event = Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        return self.parent is not None and self.parent.cancelled
+
+
+class _ScanStopped(Exception):
+    pass
+
+
+class ScanStats:
+    """
+    counters that tag_glob updates as it lists and matches directories
+    """
+
+    def __init__(self):
+        self.directories = 0
+        self.entries = 0
+        self.pruned = 0
+        self.matched = 0
+        self.stopped: Optional[str] = None
+
+        self._lock = Lock()
+
+    def add(self, directories=0, entries=0, pruned=0, matched=0):
+        with self._lock:
+            self.directories += directories
+            self.entries += entries
+            self.pruned += pruned
+            self.matched += matched
+
+    def __repr__(self):
+        return (
+            f"ScanStats(directories={self.directories}, entries={self.entries}, "
+            f"pruned={self.pruned}, matched={self.matched}, stopped={self.stopped!r})"
+        )
+
+
+class _GlobContext:
+    def __init__(
+        self,
+        fan_out,
+        stats,
+        backend,
+        token,
+        deadline,
+        max_depth,
+        follow_symlinks,
+        root_tagdict,
+        exclude,
+        tag_filters,
+    ):
+        self.fan_out = fan_out
+        self.stats = stats
+        self.backend = backend
+        self.token = token
+        self.deadline = deadline
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.root_tagdict = root_tagdict
+        self.exclude = exclude
+        self.tag_filters = tag_filters
+
+    def check(self):
+        if self.token is not None and self.token.cancelled:
+            self.stop("cancelled")
+        if self.deadline is not None and monotonic() > self.deadline:
+            self.stop("deadline")
+
+    def stop(self, reason):
+        if self.stats is not None:
+            self.stats.stopped = reason
+        raise _ScanStopped(reason)
+
+
+@contextmanager
+def _glob_context(
+    max_workers=None,
+    ordered=True,
+    stats=None,
+    backend=None,
+    token=None,
+    deadline=None,
+    max_depth=None,
+    follow_symlinks=True,
+    root_tagdict=None,
+    exclude=None,
+    tag_filters=None,
+):
+    if backend is None:
+        backend = dircache
+    if root_tagdict is None:
+        root_tagdict = dict()
+    exclude = exclude_rules(exclude)
+    if tag_filters is None:
+        tag_filters = dict()
+    tag_filters = {
+        tag_name: TagFilter.create(tag_filter) for tag_name, tag_filter in tag_filters.items()
+    }
+
+    fan_out = None
+    if max_workers is not None and max_workers > 1:
+        fan_out = _FanOut(ThreadPoolExecutor(max_workers=max_workers), max_workers, ordered)
+
+    try:
+        yield _GlobContext(
+            fan_out,
+            stats,
+            backend,
+            token,
+            deadline,
+            max_depth,
+            follow_symlinks,
+            root_tagdict,
+            exclude,
+            tag_filters,
+        )
+    except _ScanStopped:
+        pass
+    finally:
+        if fan_out is not None:
+            fan_out.shutdown()
+
+
+def _limit(results, max_results, ctx):
+    if max_results is None:
+        yield from results
+        return
+    if max_results <= 0:
+        return
+    nresult = 0
+    for result in results:
+        yield result
+        nresult += 1
+        if nresult >= max_results:
+            ctx.stop("max_results")
+
+
+def _tag_glob_parts(pathname, entities, dironly, ctx):
+    """
+    yields the tags of the parent directories and of the basename
+    separately, so that callers can decide whether to combine them,
+    along with the directory entry of the match
+    """
+    roots = _compile_tree([pathname], entities, frozenset(ctx.root_tagdict), ctx.tag_filters)
+    for root, node in roots.items():
+        results = _walk(root, dict(ctx.root_tagdict), node, dironly, ctx)
+        for _, path, dirtagdict, tagdict, entry in results:
+            yield (path, dirtagdict, tagdict, entry)
+
+
+def _tag_glob_processes(
+    pathname,
+    entities,
+    dironly,
+    processes,
+    ordered,
+    stats,
+    backend,
+    token,
+    deadline,
+    max_results,
+    records,
+    stat,
+    max_depth,
+    follow_symlinks,
+    exclude,
+    tag_filters,
+):
+    exclude = exclude_rules(exclude)  # the workers do not share the configuration
+    GlobProcessPool.check_args(exclude, tag_filters)
+
+    pool: Optional[GlobProcessPool] = None
+    if isinstance(processes, GlobProcessPool):
+        pool, owned = processes, False
+    elif isinstance(processes, Executor):
+        owned = False
+    else:
+        pool, owned = GlobProcessPool(processes), True
+
+    if backend is dircache:
+        backend = None  # every worker has its own cache
+
+    try:
+        with _glob_context(
+            stats=stats,
+            backend=backend,
+            token=token,
+            deadline=deadline,
+            exclude=exclude,
+            tag_filters=tag_filters,
+        ) as ctx:
+            shards = [(pathname, dict())]
+
+            split = _split_first_magic_dir(pathname)
+            if split is not None:
+                head, component, rest = split
+                match = _translate(
+                    component,
+                    entities,
+                    dict(),
+                    _component_filters(_tags_in_pattern(component), ctx.tag_filters),
+                )
+                shards = [
+                    (op.join(head, _glob_escape(name)) + rest, tagdict)
+                    for name, tagdict, _ in _match_names(_iterdir(head, True, ctx), match, dict(), ctx)
+                ]
+
+            options = (
+                backend,
+                deadline,
+                max_results,
+                records,
+                stat,
+                max_depth,
+                follow_symlinks,
+                exclude,
+                ctx.tag_filters,
+            )
+            args = [(shard, entities, dironly, tagdict, options) for shard, tagdict in shards]
+            if pool is not None:
+                results = pool._map(args, ordered, ctx)
+            else:
+                results = _map_executor(processes, args, ordered, ctx)
+            try:
+                yield from _limit(results, max_results, ctx)
+            finally:
+                results.close()  # so that the workers stop now
+    finally:
+        if pool is not None and owned:
+            pool.shutdown()
+
+
+def _map_executor(executor, args, ordered, ctx):
+    fan_out = _FanOut(executor, os.cpu_count() or 1, ordered, owned=False)
+    for _, (shard_results, shard_stats) in fan_out.map(_glob_shard, args):
+        if ctx.stats is not None:
+            ctx.stats.add(*shard_stats)
+        for result in shard_results:
+            ctx.check()
+            yield result
+
+
+class GlobProcessPool:
+    """
+    worker processes for tag_glob that can be kept across scans. the
+    workers send the results of a shard in chunks while they scan it,
+    and check a cancel event that is shared through a manager process,
+    so that a stopped scan does not keep a worker busy
+    """
+
+    def __init__(self, processes: int):
+        mp_context = get_context("spawn")  # forking a threaded process is unsafe
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(processes, mp_context=mp_context)
+
+        self._mp_context = mp_context
+        self._manager = None
+        self._lock = Lock()
+        self._pending: Set[Future] = set()
+
+    @property
+    def manager(self):
+        with self._lock:
+            if self._manager is None:
+                self._manager = self._mp_context.Manager()
+            return self._manager
+
+    def shutdown(self):
+        """
+        shards that have not started yet are cancelled. waits for the
+        workers, as they use the manager until they return
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        for future in pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            manager, self._manager = self._manager, None
+        if manager is not None:
+            manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    @staticmethod
+    def check_args(exclude=None, tag_filters=None):
+        """
+        raises ValueError if the exclude rules or the tag filters cannot
+        be sent to the workers, such as lambdas and nested functions
+        """
+        try:
+            pickle.dumps((exclude_rules(exclude), tag_filters))
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError(
+                "Exclude rules and tag filters need to be picklable "
+                f"to be matched in worker processes ({e})"
+            ) from e
+
+    def _submit(self, *args) -> Future:
+        future = self.executor.submit(_glob_shard, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _map(self, args: Iterable[Tuple], ordered, ctx):
+        """
+        yields the results of the shards as the workers send them, in the
+        order of the shards if ordered
+        """
+        manager = self.manager
+        queue = manager.Queue()
+        cancelled = manager.Event()
+
+        argsiter = enumerate(args)
+        futures: Dict[int, Future] = dict()
+        chunks: Dict[int, List[List]] = dict()
+        finished: Set[int] = set()
+        next_index = 0
+
+        def _submit_next():
+            for index, shard_args in argsiter:
+                futures[index] = self._submit(*shard_args, (index, queue, cancelled))
+                return
+
+        try:
+            for _ in range(2 * self.processes):
+                _submit_next()
+
+            while len(futures) > 0:
+                ctx.check()
+                try:
+                    index, results, is_last = queue.get(timeout=shard_chunk_interval)
+                except Empty:
+                    for future in futures.values():
+                        if future.done() and future.exception() is not None:
+                            future.result()  # the worker has died
+                    continue
+
+                if is_last:
+                    _, shard_stats = futures.pop(index).result()
+                    if ctx.stats is not None:
+                        ctx.stats.add(*shard_stats)
+                    finished.add(index)
+                    _submit_next()
+
+                if not ordered:
+                    yield from results
+                    continue
+
+                chunks.setdefault(index, list()).append(results)
+                while next_index in chunks:
+                    for results in chunks.pop(next_index):
+                        yield from results
+                    if next_index not in finished:
+                        break
+                    finished.discard(next_index)
+                    next_index += 1
+        finally:
+            cancelled.set()
+            for future in futures.values():
+                future.cancel()
+
+
+class _SharedToken:
+    """
+    a cancel token that reads an event of a manager process, which is a
+    round trip, so it is read at most every shard_chunk_interval seconds
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self._cancelled = event.is_set()
+        self._checked = monotonic()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._cancelled and monotonic() - self._checked >= shard_chunk_interval:
+            self._cancelled = self.event.is_set()
+            self._checked = monotonic()
+        return self._cancelled
+
+
+def _split_first_magic_dir(pathname) -> Optional[Tuple[str, str, str]]:
+    """
+    split an absolute pathname around its first magic directory component
+    """
+    parts = pathname.split("/")
+    for k, part in enumerate(parts[:-1]):
+        if not has_magic(part):
+            continue
+        if k == 0 or _isrecursive(part):
+            return None
+        return "/".join(parts[:k]) or "/", part, "/".join(parts[k + 1:])
+    return None
+
+
+def _glob_escape(name) -> str:
+    return "".join(f"[{c}]" if c in "*?[{}" else c for c in name)
+
+
+def _glob_shard(pathname, entities, dironly, root_tagdict, options, channel=None):
+    """
+    with a channel, the results are put on its queue in chunks, and the
+    last chunk is marked, even if the shard fails
+    """
+    (
+        backend,
+        deadline,
+        max_results,
+        records,
+        stat,
+        max_depth,
+        follow_symlinks,
+        exclude,
+        tag_filters,
+    ) = options
+    token = None
+    if channel is not None:
+        index, queue, cancelled = channel
+        token = _SharedToken(cancelled)
+    stats = ScanStats()
+    results: List = list()
+    sent = monotonic()
+    try:
+        with _glob_context(
+            stats=stats,
+            backend=backend,
+            token=token,
+            deadline=deadline,
+            max_depth=max_depth,
+            follow_symlinks=follow_symlinks,
+            root_tagdict=root_tagdict,
+            exclude=exclude,
+            tag_filters=tag_filters,
+        ) as ctx:
+            parts = _tag_glob_parts(pathname, entities, dironly, ctx)
+            for path, dirtagdict, tagdict, entry in _limit(parts, max_results, ctx):
+                tagdict = _combine_tagdict(dirtagdict, tagdict)
+                if records:
+                    results.append(_make_record(path, tagdict, entry, stat))
+                else:
+                    results.append((path, tagdict))
+                if channel is None:
+                    continue
+                if len(results) >= shard_chunk_size or monotonic() - sent >= shard_chunk_interval:
+                    queue.put((index, results, False))
+                    results = list()
+                    sent = monotonic()
+    finally:
+        if channel is not None:
+            queue.put((index, results, True))
+            results = list()
+    return results, (stats.directories, stats.entries, stats.pruned, stats.matched)
+
+
+class _FanOut:
+    """
+    runs per-directory work on an executor while keeping at most a few
+    tasks per worker in flight
+    """
+
+    def __init__(self, executor, nworker, ordered, owned=True):
+        self.executor = executor
+        self.window = 2 * nworker
+        self.ordered = ordered
+        self.owned = owned
+
+    def shutdown(self):
+        if self.owned:
+            self.executor.shutdown(wait=False)
+
+    def map(self, fn, argsiter) -> Generator[Tuple[Tuple, Any], None, None]:
+        pending: Deque[Future] = deque()
+        try:
+            for args in argsiter:
+                future = self.executor.submit(fn, *args)
+                future.args = args
+                pending.append(future)
+                while len(pending) >= self.window:
+                    yield from self._drain(pending)
+            while len(pending) > 0:
+                yield from self._drain(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _drain(self, pending):
+        if self.ordered:
+            future = pending.popleft()
+            yield (future.args, future.result())
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            yield (future.args, future.result())
 
 
 def _combine_tagdict(a, b) -> Dict:
@@ -52,18 +756,237 @@ def _combine_tagdict(a, b) -> Dict:
     return z
 
 
-def _tag_glob_in_dir(dirname, basename, entities, dironly, parenttagdict):
+def _match_names(names, match, dirtagdict, ctx):
     """
-    adapted from cpython glob
-    only basename can contain magic
+    names are (name, entry) pairs as yielded by _iterdir. yields the
+    tags that the match adds to dirtagdict
     """
-    # print("60", repr(dirname), repr(basename), repr(entities), repr(parenttagdict))
-    assert not has_magic(dirname)
-    match = _translate(basename, entities, parenttagdict)
-    for x in _iterdir(dirname, dironly):
-        matchobj = match(x)
-        if matchobj is not None:
-            yield x, matchobj.groupdict()
+    nentries, npruned, nmatched = 0, 0, 0
+    try:
+        for x, entry in names:
+            nentries += 1
+            if not match.prefilter(x):
+                npruned += 1
+                continue
+            matchobj = match(x)
+            if matchobj is None:
+                continue
+            tagdict = matchobj.groupdict()
+            if len(match.bound) > 0:
+                tagdict = match.bind(x, tagdict, dirtagdict)
+                if tagdict is None:
+                    continue
+            nmatched += 1
+            yield x, tagdict, entry
+    finally:
+        if ctx.stats is not None:
+            ctx.stats.add(1, nentries, npruned, nmatched)
+
+
+def tag_glob_many(
+    patterns,
+    entities=None,
+    dironly=False,
+    stats=None,
+    backend=None,
+    token=None,
+    deadline=None,
+    max_results=None,
+    records=False,
+    stat=False,
+    max_depth=None,
+    follow_symlinks=True,
+    exclude=None,
+    tag_filters=None,
+) -> Generator[Union[Tuple[int, str, Dict], Tuple[int, GlobRecord]], None, None]:
+    """
+    match several patterns in a single traversal. patterns are merged
+    into a tree of path components, so that common leading components
+    are matched once and every directory is listed at most once
+
+    yields (index of the pattern, path, tagdict), or (index of the
+    pattern, GlobRecord) with records
+    """
+    def _walk_roots(ctx):
+        roots = _compile_tree(patterns, entities, tag_filters=ctx.tag_filters)
+        for root, node in roots.items():
+            yield from _walk(root, dict(), node, dironly, ctx)
+
+    with _glob_context(
+        stats=stats,
+        backend=backend,
+        token=token,
+        deadline=deadline,
+        max_depth=max_depth,
+        follow_symlinks=follow_symlinks,
+        exclude=exclude,
+        tag_filters=tag_filters,
+    ) as ctx:
+        for index, path, dirtagdict, tagdict, entry in _limit(_walk_roots(ctx), max_results, ctx):
+            tagdict = _combine_tagdict(dirtagdict, tagdict)
+            if records:
+                yield (index, _make_record(path, tagdict, entry, stat))
+            else:
+                yield (index, path, tagdict)
+
+
+class _PatternNode:
+    """
+    one path component of the patterns. the component is compiled once,
+    so that no directory needs a matcher of its own. match is None for
+    components that are descended into without listing
+    """
+
+    def __init__(self):
+        self.children: Dict[str, _PatternNode] = dict()
+        self.indices: List[int] = list()
+        self.recursive = False
+        self.match: Optional[_Matcher] = None
+
+
+def _compile_tree(
+    patterns, entities, bound=frozenset(), tag_filters=None
+) -> Dict[str, _PatternNode]:
+    """
+    bound are the tags that are already known when the walk starts
+    """
+    if tag_filters is None:
+        tag_filters = dict()
+    if entities is not None:
+        entities = frozenset(entities)
+
+    roots: Dict[str, _PatternNode] = dict()
+    for index, pathname in enumerate(patterns):
+        components = pathname.split("/")
+        *dirnames, basename = components
+        if op.isabs(pathname):
+            root = "/"
+        else:
+            root = ""
+        node = roots.setdefault(root, _PatternNode())
+        for component in dirnames:
+            if len(component) > 0:
+                node = node.children.setdefault(component, _PatternNode())
+        node = node.children.setdefault(basename, _PatternNode())
+        node.indices.append(index)
+
+    stack = [(node, bound) for node in roots.values()]
+    while len(stack) > 0:
+        node, bound = stack.pop()
+        for component, child in node.children.items():
+            tags = _tags_in_pattern(component)
+            if entities is not None:
+                tags = tags & entities
+            if _isrecursive(component):
+                child.recursive = True
+            elif len(child.indices) > 0 or has_magic(component):
+                child.match = _compile_translation(
+                    component,
+                    entities,
+                    (),
+                    tags & bound,
+                    _component_filters(tags - bound, tag_filters),
+                )
+            stack.append((child, bound | tags))
+
+    return roots
+
+
+def _component_filters(tags, tag_filters) -> Tuple[Tuple[str, TagFilter], ...]:
+    return tuple(
+        (tag_name, tag_filters[tag_name]) for tag_name in sorted(tags) if tag_name in tag_filters
+    )
+
+
+def _walk(dirname, dirtagdict, node, dironly, ctx, names=None):
+    """
+    match the entries of dirname against the children of node. the
+    tags bound by the parent directories are carried along in
+    dirtagdict
+
+    yields (index of the pattern, path, dirtagdict, tagdict, entry)
+    """
+    ctx.check()
+
+    matched_children = list()
+    for component, child in node.children.items():
+        if child.recursive:
+            yield from _walk_recursive(dirname, dirtagdict, child, dironly, ctx)
+        elif child.match is None:  # nothing to match, so descend without listing
+            yield from _walk(op.join(dirname, component, ""), dirtagdict, child, dironly, ctx)
+        else:
+            matched_children.append(child)
+
+    if len(matched_children) == 0:
+        return
+
+    if names is None:
+        names = _list_for_walk(dirname, node, dironly, ctx)
+
+    for child in matched_children:
+        results = _match_names(names, child.match, dirtagdict, ctx)
+        if len(child.indices) == 0:
+            subdirs = (
+                (op.join(dirname, name), _combine_tagdict(dirtagdict, tagdict), child)
+                for name, tagdict, _ in results
+                if name.endswith("/")
+            )
+            yield from _descend(subdirs, dironly, ctx)
+            continue
+        for name, tagdict, entry in results:
+            path = op.join(dirname, name)
+            is_dir = name.endswith("/")
+            if not dironly or is_dir:
+                for index in child.indices:
+                    yield (index, path, dirtagdict, tagdict, entry)
+            if is_dir and len(child.children) > 0:
+                yield from _walk(
+                    path, _combine_tagdict(dirtagdict, tagdict), child, dironly, ctx
+                )
+
+
+def _walk_recursive(dirname, dirtagdict, node, dironly, ctx):
+    needs_files = not dironly and len(node.indices) > 0
+    paths = _rlistdir(dirname, not needs_files, ctx)
+    if dirname:
+        paths = itertools.chain([(op.join(dirname, ""), None)], paths)  # zero directories
+    if len(node.indices) == 0:
+        yield from _descend(((path, dirtagdict, node) for path, _ in paths), dironly, ctx)
+        return
+    for path, entry in paths:
+        is_dir = path.endswith("/")
+        if not dironly or is_dir:
+            for index in node.indices:
+                yield (index, path, dirtagdict, dict(), entry)
+        if is_dir and len(node.children) > 0:
+            yield from _walk(path, dirtagdict, node, dironly, ctx)
+
+
+def _descend(subdirs, dironly, ctx):
+    """
+    walk (path, dirtagdict, node) triples in order. with a fan out, the
+    directories are listed concurrently ahead of the walk
+    """
+    if ctx.fan_out is None:
+        for path, dirtagdict, node in subdirs:
+            yield from _walk(path, dirtagdict, node, dironly, ctx)
+        return
+    results = ctx.fan_out.map(_list_subdir, ((subdir, dironly, ctx) for subdir in subdirs))
+    for ((path, dirtagdict, node), _, _), names in results:
+        yield from _walk(path, dirtagdict, node, dironly, ctx, names)
+
+
+def _list_for_walk(dirname, node, dironly, ctx) -> Optional[List[Tuple[str, Any]]]:
+    matched_children = [child for child in node.children.values() if child.match is not None]
+    if len(matched_children) == 0:
+        return None
+    needs_files = not dironly and any(len(child.indices) > 0 for child in matched_children)
+    return list(_iterdir(dirname, not needs_files, ctx))
+
+
+def _list_subdir(subdir, dironly, ctx):
+    path, _, node = subdir
+    return _list_for_walk(path, node, dironly, ctx)
 
 
 def get_entities_in_path(pat):
@@ -79,6 +1002,7 @@ def get_entities_in_path(pat):
     return res
 
 
+@lru_cache(maxsize=translate_cache_size)
 def _validate_re(s):
     try:
         re.compile(s)
@@ -88,8 +1012,171 @@ def _validate_re(s):
     return False
 
 
-def _translate(pat, entities, parenttagdict):
+@lru_cache(maxsize=translate_cache_size)
+def _check_regex(s) -> Optional[str]:
+    return check_regex(s)
+
+
+@lru_cache(maxsize=translate_cache_size)
+def _tags_in_pattern(pat) -> FrozenSet[str]:
+    return frozenset(get_entities_in_path(pat))
+
+
+def _translate(pat, entities, parenttagdict, filters=()):
+    """
+    look up the compiled matcher for a basename pattern, keyed only on
+    the parent tag values that are actually substituted into it
+    """
+    if entities is not None and not isinstance(entities, frozenset):
+        entities = frozenset(entities)
+
+    tags = _tags_in_pattern(pat)
+    if entities is not None:
+        tags = tags & entities
+    substitutions = tuple(sorted(
+        (tag_name, parenttagdict[tag_name]) for tag_name in tags if tag_name in parenttagdict
+    ))
+
+    return _compile_translation(pat, entities, substitutions, frozenset(), filters)
+
+
+def translate_cache_info():
+    return _compile_translation.cache_info()
+
+
+def translate_cache_clear():
+    _compile_translation.cache_clear()
+
+
+class _Matcher:
+    """
+    compiled basename pattern together with the literal text that any
+    match must contain, so that most names can be rejected without
+    running the regex
+    """
+
+    __slots__ = (
+        "fullmatch",
+        "prefix",
+        "suffix",
+        "required",
+        "pat",
+        "entities",
+        "bound",
+        "filters",
+        "checks",
+        "slice_checks",
+    )
+
+    def __init__(self, fullmatch, pieces, pat, entities, bound, filters, checks, slice_checks):
+        self.fullmatch = fullmatch
+
+        self.pat = pat
+        self.entities = entities
+        self.bound = bound
+        self.filters = filters
+        self.checks = checks
+        self.slice_checks = slice_checks
+
+        literals: List[Optional[str]] = []  # None stands for a wildcard
+        for piece in pieces:
+            if piece is None:
+                if len(literals) == 0 or literals[-1] is not None:
+                    literals.append(None)
+            elif len(piece) > 0:
+                if len(literals) > 0 and literals[-1] is not None:
+                    literals[-1] += piece
+                else:
+                    literals.append(piece)
+
+        self.prefix = ""
+        self.suffix = ""
+        if len(literals) > 0 and literals[0] is not None:
+            self.prefix = literals.pop(0)
+        if len(literals) > 0 and literals[-1] is not None:
+            self.suffix = literals.pop(-1)
+        self.required = tuple(literal for literal in literals if literal is not None)
+
+    def prefilter(self, name) -> bool:
+        if name.endswith("/"):
+            name = name[:-1]
+        if not name.startswith(self.prefix) or not name.endswith(self.suffix):
+            return False
+        pos = len(self.prefix)
+        end = len(name) - len(self.suffix)
+        if end < pos:
+            return False
+        for literal in self.required:
+            pos = name.find(literal, pos, end)
+            if pos < 0:
+                return False
+            pos += len(literal)
+        if len(self.slice_checks) > 0:  # check the tag value without the regex
+            value = name[pos:end]
+            return all(tag_filter(value) for tag_filter in self.slice_checks)
+        return True
+
+    def __call__(self, name):
+        matchobj = self.fullmatch(name)
+        if matchobj is not None:
+            for tag_name, tag_filter in self.checks:
+                if not tag_filter(matchobj.group(tag_name)):
+                    return None
+        return matchobj
+
+    def bind(self, name, tagdict, parenttagdict) -> Optional[Dict]:
+        """
+        compare the tags in bound to the values that the parent
+        directories bound them to, and drop them from tagdict. where the
+        match split name differently, match again with the parent values
+        substituted
+        """
+        for tag_name in self.bound:
+            s = parenttagdict.get(tag_name)
+            if s is None:
+                continue
+            if s.endswith("/"):
+                s = s[:-1]
+            if tagdict[tag_name] != s:
+                matchobj = _translate(self.pat, self.entities, parenttagdict, self.filters)(name)
+                if matchobj is None:
+                    return None
+                return matchobj.groupdict()
+        return {k: v for k, v in tagdict.items() if k not in parenttagdict}
+
+
+def _glob_pieces(pat) -> List[Optional[str]]:
+    """
+    split a glob pattern into literal text and None for each wildcard
+    """
+    pieces: List[Optional[str]] = []
+    for i, piece in enumerate(glob_magic_split.split(pat)):
+        if i % 2 == 1:
+            pieces.append(None)
+        elif "[" in piece:  # unterminated character class, stop being clever
+            pieces.append(piece[: piece.index("[")])
+            pieces.append(None)
+            break
+        else:
+            pieces.append(piece)
+    return pieces
+
+
+@lru_cache(maxsize=translate_cache_size)
+def _compile_translation(pat, entities, substitutions, bound=frozenset(), filters=()):
+    """
+    tags in bound are captured without their filter, as their value was
+    already decided by a parent directory. filters are (tag_name,
+    TagFilter) pairs in addition to the filters in the pattern
+    """
+    parenttagdict = dict(substitutions)
+    filterdict = dict(filters)
+
     res = ""
+    pieces: List[Optional[str]] = []
+    checks: List[Tuple[str, TagFilter]] = []
+    wildcard_tags: List[Optional[str]] = []
+    has_regex_filter = False
 
     tokens = tokenize.split(pat)
 
@@ -112,16 +1199,32 @@ def _translate(pat, entities, parenttagdict):
                     if s.endswith("/"):
                         s = s[:-1]
                     res += re.escape(s)
+                    pieces.append(s)
                     # TODO warning that filter is ignored
                     continue
 
                 enre = None
-                if filter_str is not None:
+                tag_filters = list()
+                if filter_str is not None and tag_name not in bound:
                     if filter_type == ":":
                         enre = filter_str.replace("\\{", "{").replace("\\}", "}")  # regex syntax
-                    elif filter_type == "=":  # glob syntax
-                        enre = fnmatch.translate(filter_str)
-                        enre = special_match.sub("", enre)  # remove control codes
+                        if _validate_re(enre):
+                            reason = _check_regex(enre)
+                            if reason is not None:
+                                raise UnsafeFilterError(f"Filter {token} {reason}")
+                            has_regex_filter = True
+                    elif filter_type == "=":
+                        tag_filter = TagFilter.parse(filter_str)
+                        if tag_filter is not None:  # range or set syntax
+                            tag_filters.append(tag_filter)
+                            enre = tag_filter.regex
+                        else:  # glob syntax
+                            enre = fnmatch.translate(filter_str)
+                            enre = special_match.sub("", enre)  # remove control codes
+                if tag_name in filterdict and tag_name not in bound:
+                    tag_filters.append(filterdict[tag_name])
+                    if enre is None:
+                        enre = filterdict[tag_name].regex
 
                 if enre is None or not _validate_re(enre):
                     enre = r"[^/]+"
@@ -129,54 +1232,112 @@ def _translate(pat, entities, parenttagdict):
                 if tag_name not in entities_in_res:
                     res += r"(?P<%s>%s)" % (tag_name, enre)
                     entities_in_res.add(tag_name)
+                    checks.extend((tag_name, tag_filter) for tag_filter in tag_filters)
                 else:
                     res += r"(?P=%s)" % tag_name
+                pieces.append(None)
+                wildcard_tags.append(tag_name)
             else:
                 res += re.escape(token)
+                pieces.append(token)
 
         else:
             fnre = fnmatch.translate(token)
             fnre = special_match.sub("", fnre)
             fnre = fnre.replace(".*", "[^/]*")
             res += fnre
+            token_pieces = _glob_pieces(token)
+            pieces.extend(token_pieces)
+            wildcard_tags.extend(None for piece in token_pieces if piece is None)
 
     res += "/?"
 
-    return re.compile(res).fullmatch
+    slice_checks: Tuple[TagFilter, ...] = ()
+    if len(wildcard_tags) == 1:  # the text between prefix and suffix is the tag value
+        slice_checks = tuple(
+            tag_filter for tag_name, tag_filter in checks if tag_name == wildcard_tags[0]
+        )
 
+    return _Matcher(
+        compile_fullmatch(res, has_regex_filter),
+        pieces,
+        pat,
+        entities,
+        bound,
+        filters,
+        tuple(checks),
+        slice_checks,
+    )
 
-def _iterdir(dirname, dironly):
+
+def _iterdir(dirname, dironly, ctx):
     """
     adapted from cpython glob
+    yields (name, entry) pairs, where directory names end with a slash.
+    excluded entries are skipped, so that they are never descended into
     """
     if not dirname:
         dirname = os.curdir
+    ctx.check()
     try:
-        with os.scandir(dirname) as it:
-            for entry in it:
-                try:
-                    if not dironly or entry.is_dir():
-                        entry_name = entry.name
-                        if entry.is_dir():
-                            entry_name = op.join(entry_name, "")
-                        if not _ishidden(entry_name):
-                            yield entry_name
-                except OSError:
-                    pass
+        entries = ctx.backend.listdir(dirname)
     except OSError:
         return
+    exclude = ctx.exclude
+    if exclude:
+        parent = op.abspath(dirname)
+    for entry in entries:
+        ctx.check()
+        if not dironly or entry.is_dir:
+            entry_name = entry.name
+            if entry.is_dir:
+                entry_name = op.join(entry_name, "")
+            if _ishidden(entry_name):
+                continue
+            if exclude and exclude.excluded(op.join(parent, entry.name), entry.is_dir):
+                continue
+            yield entry_name, entry
 
 
-def _rlistdir(dirname, dironly):
+def _rlistdir(dirname, dironly, ctx):
     """
-    adapted from cpython glob
+    adapted from cpython glob, but walks with an explicit stack of
+    listings, so that there is no recursion limit and the first results
+    are yielded before the subtree is listed
+
+    yields (path, entry) pairs in the same order as cpython glob
     """
-    names = list(_iterdir(dirname, dironly))
-    for x in names:
-        path = op.join(dirname, x) if dirname else x
-        yield path
+    seen = set()
+    if ctx.follow_symlinks:
+        seen.add(ctx.backend.identity(dirname))
+
+    stack = [(dirname, _iterdir(dirname, dironly, ctx))]
+    while len(stack) > 0:
+        parent, names = stack[-1]
+        item = next(names, None)
+        if item is None:
+            stack.pop()
+            continue
+        ctx.check()
+
+        x, entry = item
+        path = op.join(parent, x) if parent else x
+        yield path, entry
+
+        if not entry.is_dir:
+            continue
+        if ctx.max_depth is not None and len(stack) >= ctx.max_depth:
+            continue
+        if entry.is_symlink and not ctx.follow_symlinks:
+            continue
+        if ctx.follow_symlinks:
+            identity = ctx.backend.identity(path)
+            if identity is not None:
+                if identity in seen:
+                    continue
+                seen.add(identity)
         # print("176", repr(dirname), repr(path))
-        yield from _rlistdir(path, dironly)
+        stack.append((path, _iterdir(path, dironly, ctx)))
 
 
 def has_magic(s):
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+match tagged patterns against paths that are already known, without
+touching the file system
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+import os
+from os import path as op
+
+from ..dircache import DirEntryInfo
+from ..exclude import ExcludeRules
+from .columnar import TagColumns
+from .glob import _glob_context, _limit, _tag_glob_parts
+
+
+def tag_match(
+    pattern,
+    paths: Iterable,
+    entities=None,
+    dironly=False,
+    max_results=None,
+    tag_filters=None,
+) -> TagColumns:
+    """
+    like tag_glob_columns, but matches against paths instead of the
+    file system. paths can be any iterable of str, bytes or path-like
+    objects, including numpy arrays. a path that ends with a slash, or
+    that has other paths below it, is a directory
+
+    the paths are grouped into a tree of directories first, so that
+    every component of the pattern is matched once for every distinct
+    name in a directory. relative patterns only match relative paths,
+    and absolute patterns only match absolute paths
+    """
+    columns = TagColumns()
+    with _glob_context(
+        backend=PathTree(paths),
+        follow_symlinks=False,
+        exclude=ExcludeRules(()),  # the caller has chosen the paths
+        tag_filters=tag_filters,
+    ) as ctx:
+        results = _limit(_tag_glob_parts(pattern, entities, dironly, ctx), max_results, ctx)
+        for path, dirtagdict, tagdict, _ in results:
+            columns.append(path, dirtagdict, tagdict)
+    return columns
+
+
+class PathTree:
+    """
+    a backend for the glob functions that lists directories from a
+    mapping of directory to the names in it
+    """
+
+    def __init__(self, paths: Iterable):
+        self._names_by_dir: Dict[str, Dict[str, bool]] = dict()
+
+        for path in paths:
+            path = os.fsdecode(path)
+            if len(path) == 0:
+                continue
+            is_dir = path.endswith("/")
+            path = op.normpath(path)
+            while True:
+                dirname, name = op.split(path)
+                if not name or name == os.curdir:  # reached the root
+                    break
+                names = self._names_by_dir.setdefault(dirname or os.curdir, dict())
+                if names.get(name) is not None:
+                    names[name] = names[name] or is_dir
+                    break  # the parents were added before
+                names[name] = is_dir
+                path, is_dir = dirname, True
+                if not path:
+                    break
+
+        self._entries: Dict[str, Tuple[DirEntryInfo, ...]] = dict()
+
+    def listdir(self, path) -> Tuple[DirEntryInfo, ...]:
+        """
+        same interface as DirectoryCache.listdir
+        """
+        key = op.normpath(path or os.curdir)
+        entries = self._entries.get(key)
+        if entries is None:
+            names = self._names_by_dir.get(key)
+            if names is None:
+                raise FileNotFoundError(key)
+            entries = tuple(
+                DirEntryInfo(name, is_dir, not is_dir, False) for name, is_dir in names.items()
+            )
+            self._entries[key] = entries
+        return entries
+
+    def identity(self, path) -> Optional[Tuple[int, int]]:
+        return None
@@ -13,6 +13,8 @@ magic_check = re.compile(r"(?:\*|\?|(?:\A|[^\\]){|[^\\]})")
 
 special_match = re.compile(r"(\\[AbBdDsDwWZ])")
 
+glob_magic_split = re.compile(r"(\*|\?|\[!?\]?[^\]]*\])")
+
 suggestion_match = re.compile(r"({suggestion(?:[:=][^}]+)?})")
 
 chartype_filter = re.compile(r"(\[.+\])")
@@ -20,3 +22,5 @@ chartype_filter = re.compile(r"(\[.+\])")
 show_tag_suggestion_check = re.compile(r".*(?P<newtag>{(?P<tag_name>[a-z]*))(?P<newfilter>[:=][^}]+)?\Z")
 
 remove_tag_remainder_match = re.compile(r"(?P<oldtag>[^}]*?})")
+
+range_filter_match = re.compile(r"(?P<start>\d+)\.\.(?P<stop>\d+)")
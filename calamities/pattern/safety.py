@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+reject regex filters that can backtrack catastrophically, and bound the
+time of a match where the regex module is available
+"""
+from typing import Callable, FrozenSet, Optional
+
+import re
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # python < 3.11
+    import sre_parse
+    import sre_constants
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+match_timeout = 0.1
+
+# repeats with more iterations than this are treated like unbounded ones
+max_bounded_repeat = 16
+
+# every further unbounded quantifier in a sequence multiplies the ways to
+# split a name, even when literals separate them
+max_unbounded_quantifiers = 2
+
+_repeats = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+class UnsafeFilterError(ValueError):
+    pass
+
+
+def check_regex(s) -> Optional[str]:
+    """
+    returns why the regex is unsafe to match, or None. nested
+    quantifiers, ambiguous alternatives under a quantifier, more than
+    max_unbounded_quantifiers unbounded quantifiers in a sequence and
+    backreferences are rejected
+    """
+    try:
+        parsed = sre_parse.parse(s)
+    except Exception as e:
+        return f"is not a valid regular expression ({e})"
+    reason = _check(parsed, False)
+    if reason is None and _count_unbounded(parsed) > max_unbounded_quantifiers:
+        reason = "has too many unbounded quantifiers"
+    return reason
+
+
+def _is_risky(lo, hi, body) -> bool:
+    """
+    a small bounded repeat is only safe if every iteration has one way
+    to match, as the ways multiply across the iterations
+    """
+    if hi == sre_constants.MAXREPEAT or hi > max_bounded_repeat:
+        return True
+    return hi > 1 and _has_quantifier(body)
+
+
+def _has_quantifier(subpattern) -> bool:
+    for op, av in subpattern:
+        if op in _repeats:
+            lo, hi, body = av
+            if lo != hi or _has_quantifier(body):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _has_quantifier(av[-1]):
+                return True
+        elif op == sre_constants.BRANCH:
+            if any(_has_quantifier(alternative) for alternative in av[1]):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _has_quantifier(av[1]):
+                return True
+    return False
+
+
+def _count_unbounded(subpattern) -> int:
+    """
+    the number of unbounded quantifiers that a match has to pass through
+    one after the other, counting the longest alternative of a branch
+    """
+    count = 0
+    for op, av in subpattern:
+        if op in _repeats:
+            lo, hi, body = av
+            if hi == sre_constants.MAXREPEAT or hi > max_bounded_repeat:
+                count += 1
+            count += _count_unbounded(body)
+        elif op == sre_constants.SUBPATTERN:
+            count += _count_unbounded(av[-1])
+        elif op == sre_constants.BRANCH:
+            count += max(_count_unbounded(alternative) for alternative in av[1])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            count += _count_unbounded(av[1])
+    return count
+
+
+def _check(subpattern, in_risky_repeat) -> Optional[str]:
+    for op, av in subpattern:
+        if op in _repeats:
+            lo, hi, body = av
+            if in_risky_repeat and lo != hi:
+                return "has nested quantifiers"
+            risky = _is_risky(lo, hi, body)
+            reason = _check(body, in_risky_repeat or risky)
+            if reason is not None:
+                return reason
+            continue
+
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return "has a backreference"
+        elif op == sre_constants.SUBPATTERN:
+            reason = _check(av[-1], in_risky_repeat)
+        elif op == sre_constants.BRANCH:
+            _, alternatives = av
+            if in_risky_repeat and _overlap(alternatives):
+                return "has overlapping alternatives under a quantifier"
+            reason = None
+            for alternative in alternatives:
+                reason = reason or _check(alternative, in_risky_repeat)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            reason = _check(av[1], in_risky_repeat)
+        elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+            reason = _check(av, False)  # does not backtrack into the group
+        elif op == getattr(sre_constants, "POSSESSIVE_REPEAT", None):
+            reason = _check(av[2], False)
+        else:
+            reason = None
+        if reason is not None:
+            return reason
+    return None
+
+
+def _first(subpattern) -> Optional[FrozenSet[int]]:
+    """
+    the characters that a match can start with, or None if that is not
+    easy to tell
+    """
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            return frozenset([av])
+        elif op == sre_constants.IN:
+            chars = set()
+            for in_op, in_av in av:
+                if in_op == sre_constants.LITERAL:
+                    chars.add(in_av)
+                elif in_op == sre_constants.RANGE and in_av[1] - in_av[0] < 256:
+                    chars.update(range(in_av[0], in_av[1] + 1))
+                else:
+                    return None
+            return frozenset(chars)
+        elif op == sre_constants.SUBPATTERN:
+            return _first(av[-1])
+        elif op in _repeats and av[0] > 0:
+            return _first(av[2])
+        elif op == sre_constants.AT:
+            continue
+        return None
+    return None
+
+
+def _overlap(alternatives) -> bool:
+    seen = set()
+    for alternative in alternatives:
+        first = _first(alternative)
+        if first is None or not seen.isdisjoint(first):
+            return True
+        seen.update(first)
+    return False
+
+
+def compile_fullmatch(res, bounded) -> Callable:
+    """
+    with bounded and the regex module, a match that takes longer than
+    match_timeout raises UnsafeFilterError
+    """
+    if not bounded or regex is None:
+        return re.compile(res).fullmatch
+
+    compiled = regex.compile(res, regex.V0)
+
+    def fullmatch(name):
+        try:
+            return compiled.fullmatch(name, timeout=match_timeout)
+        except TimeoutError:
+            raise UnsafeFilterError(f"Matching {name!r} took longer than {match_timeout} seconds")
+
+    return fullmatch
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+filters that restrict a tag to a set of values or a numeric range. they
+are checked on the text of the tag before the regex is run
+"""
+from typing import Callable, FrozenSet, Optional
+
+import re
+
+from .re import range_filter_match
+
+max_alternation = 64
+
+
+class TagFilter:
+    """
+    values is a set of strings, numbers is a range of integers that the
+    value is compared to numerically, ignoring leading zeros, and
+    predicate is a function that takes the value
+    """
+
+    __slots__ = ("values", "numbers", "predicate")
+
+    def __init__(
+        self,
+        values: Optional[FrozenSet[str]] = None,
+        numbers: Optional[range] = None,
+        predicate: Optional[Callable[[str], bool]] = None,
+    ):
+        self.values = values
+        self.numbers = numbers
+        self.predicate = predicate
+
+    @classmethod
+    def parse(cls, filter_str) -> Optional["TagFilter"]:
+        """
+        01..50 is an inclusive range and a,b,c is a set of values.
+        returns None for other filters, which are globs
+        """
+        matchobj = range_filter_match.fullmatch(filter_str)
+        if matchobj is not None:
+            start, stop = int(matchobj.group("start")), int(matchobj.group("stop"))
+            return cls(numbers=range(start, stop + 1))
+        if "," in filter_str:
+            return cls(values=frozenset(value for value in filter_str.split(",") if value))
+        return None
+
+    @classmethod
+    def create(cls, obj) -> "TagFilter":
+        """
+        from a filter string, a range, a predicate or a collection of values
+        """
+        if isinstance(obj, TagFilter):
+            return obj
+        if isinstance(obj, str):
+            tag_filter = cls.parse(obj)
+            if tag_filter is None:
+                tag_filter = cls(values=frozenset([obj]))
+            return tag_filter
+        if isinstance(obj, range):
+            return cls(numbers=obj)
+        if callable(obj):
+            return cls(predicate=obj)
+        return cls(values=frozenset(map(str, obj)))
+
+    def _key(self):
+        return (self.values, self.numbers, self.predicate)
+
+    def __eq__(self, other):
+        return isinstance(other, TagFilter) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __reduce__(self):
+        return (TagFilter, self._key())
+
+    def __repr__(self):
+        return f"TagFilter(values={self.values!r}, numbers={self.numbers!r}, predicate={self.predicate!r})"
+
+    @property
+    def regex(self) -> str:
+        if self.numbers is not None:
+            return r"\d+"
+        if self.values is not None and 0 < len(self.values) <= max_alternation:
+            values = sorted(self.values, key=len, reverse=True)  # longest first
+            return "(?:%s)" % "|".join(map(re.escape, values))
+        return r"[^/]+"
+
+    def __call__(self, value) -> bool:
+        if self.values is not None and value not in self.values:
+            return False
+        if self.numbers is not None:
+            if not value.isdigit() or int(value) not in self.numbers:
+                return False
+        if self.predicate is not None and not self.predicate(value):
+            return False
+        return True
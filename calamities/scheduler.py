@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+coalesce bursts of scan requests, such as one per keystroke, into
+single scans that run in a background thread
+"""
+from typing import Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+import os
+import logging
+from threading import Condition, Thread
+from time import monotonic
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from .config import Config
+from .manifest import ManifestIndex
+from .pattern import GlobProcessPool
+
+logger = logging.getLogger("calamities")
+
+
+class SchedulerInfo(NamedTuple):
+    requests: int
+    scans: int
+    stale: int
+    pending: int
+
+
+class ScanScheduler:
+    """
+    scan is called from the scheduler thread with the generation of the
+    latest request. it runs once no further request has arrived for
+    debounce seconds, but at most max_wait seconds after the first
+    request of a burst. while nothing is requested, the thread waits
+    without a timeout
+
+    a scan is stale once a newer request has arrived. scans should check
+    is_current before they publish their results. refresh asks for one
+    more scan of the same generation, such as after the files have
+    changed, so that a running scan stays current
+
+    when started with a service, the scans run in the threads of the
+    service instead of a thread of their own
+    """
+
+    def __init__(
+        self,
+        scan: Callable[[int], None],
+        debounce: Optional[float] = None,
+        max_wait: Optional[float] = None,
+    ):
+        self.scan = scan
+        self.debounce = debounce
+        self.max_wait = max_wait
+
+        self.service: Optional["ScanService"] = None
+
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._is_running = False
+        self._is_scanning = False
+
+        self._generation = 0
+        self._first_request: Optional[float] = None
+        self._last_request: Optional[float] = None
+
+        self.requests = 0
+        self.scans = 0
+        self.stale = 0
+        self._pending = 0
+
+    def _get_debounce(self) -> float:
+        if self.debounce is not None:
+            return self.debounce
+        return Config.scan_debounce
+
+    def _get_max_wait(self) -> float:
+        if self.max_wait is not None:
+            return self.max_wait
+        return Config.scan_max_wait
+
+    def start(self, service: Optional["ScanService"] = None):
+        self.service = service
+        if service is not None:
+            self._condition = service._condition  # so that the service sees requests
+            service._attach(self)
+            return self
+
+        with self._condition:
+            self._is_running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        waits for a running scan to return, pending requests are dropped
+        """
+        if self.service is not None:
+            self.service._detach(self)
+        else:
+            with self._condition:
+                self._is_running = False
+                self._condition.notify_all()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+        logger.debug("Scan scheduler stopped: %s", self.info())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def request(self) -> int:
+        """
+        returns the generation of the request
+        """
+        with self._condition:
+            self._generation += 1
+            self._add_request()
+            return self._generation
+
+    def refresh(self) -> int:
+        """
+        requests a scan without making the running one stale. the scan
+        starts once the running one has returned
+        """
+        with self._condition:
+            self._add_request()
+            return self._generation
+
+    def _add_request(self):
+        """
+        is called with the lock held
+        """
+        now = monotonic()
+        if self._first_request is None:
+            self._first_request = now
+        self._last_request = now
+
+        self.requests += 1
+        self._pending += 1
+
+        self._condition.notify_all()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def is_current(self, generation) -> bool:
+        return generation == self._generation
+
+    def info(self) -> SchedulerInfo:
+        with self._condition:
+            return SchedulerInfo(self.requests, self.scans, self.stale, self._pending)
+
+    def _due(self) -> Optional[float]:
+        """
+        when the next scan should start, or None if there is nothing to
+        scan. is called with the lock held
+        """
+        if not self._is_running or self._is_scanning or self._first_request is None:
+            return None
+        assert self._last_request is not None
+        return min(
+            self._last_request + self._get_debounce(),
+            self._first_request + self._get_max_wait(),
+        )
+
+    def _begin(self) -> int:
+        """
+        is called with the lock held
+        """
+        self._first_request = None
+        self._last_request = None
+        self._pending = 0
+        self._is_scanning = True
+        self.scans += 1
+        return self._generation
+
+    def _scan(self, generation):
+        try:
+            self.scan(generation)
+        except Exception as e:
+            logger.warning("Error in scan: %s", e, exc_info=True)
+        finally:
+            with self._condition:
+                self._is_scanning = False
+                if generation != self._generation:
+                    self.stale += 1
+                self._condition.notify_all()
+
+    def _run(self):
+        with self._condition:
+            while True:
+                while self._is_running and self._first_request is None:
+                    self._condition.wait()
+                if not self._is_running:
+                    return
+
+                due = self._due()
+                assert due is not None
+                timeout = due - monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+
+                generation = self._begin()
+
+                self._condition.release()
+                try:
+                    self._scan(generation)
+                finally:
+                    self._condition.acquire()
+
+
+class ScanService:
+    """
+    runs the scans of all views of an app in one pool of at most
+    max_workers threads, so that prompts do not start threads of their
+    own and do not compete for the file system. resources that take long
+    to create, such as worker processes and manifest indices, are kept
+    until shutdown, so that later prompts can reuse them
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+
+        self._condition = Condition()
+        self._schedulers: Set[ScanScheduler] = set()
+        self._executor: Optional[Executor] = None
+        self._thread: Optional[Thread] = None
+        self._is_running = False
+
+        self._process_pools: Dict[int, GlobProcessPool] = dict()
+        self._manifest_indices: Dict[Tuple[str, int], ManifestIndex] = dict()
+
+    def _get_max_workers(self) -> int:
+        if self.max_workers is not None:
+            return self.max_workers
+        return Config.scan_max_workers
+
+    def start(self):
+        with self._condition:
+            if self._is_running:
+                return self
+            self._is_running = True
+            self._executor = ThreadPoolExecutor(
+                self._get_max_workers(), thread_name_prefix="calamities-scan"
+            )
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        """
+        waits for running scans to return
+        """
+        with self._condition:
+            self._is_running = False
+            for scheduler in self._schedulers:
+                scheduler._is_running = False
+            self._schedulers.clear()
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        for process_pool in self._process_pools.values():
+            process_pool.shutdown()
+        self._process_pools.clear()
+        self._manifest_indices.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def process_pool(self, processes: int) -> GlobProcessPool:
+        """
+        a pool of worker processes that is shared by all views
+        """
+        with self._condition:
+            process_pool = self._process_pools.get(processes)
+            if process_pool is None:
+                process_pool = GlobProcessPool(processes)
+                self._process_pools[processes] = process_pool
+            return process_pool
+
+    def manifest_index(self, manifest) -> ManifestIndex:
+        """
+        the index is read again when the manifest has changed
+        """
+        manifest = os.path.abspath(manifest)
+        key = (manifest, os.stat(manifest).st_mtime_ns)
+        with self._condition:
+            manifest_index = self._manifest_indices.get(key)
+        if manifest_index is None:
+            manifest_index = ManifestIndex(manifest)
+            with self._condition:
+                for other in [other for other in self._manifest_indices if other[0] == manifest]:
+                    del self._manifest_indices[other]
+                self._manifest_indices[key] = manifest_index
+        return manifest_index
+
+    def _attach(self, scheduler: ScanScheduler):
+        self.start()
+        with self._condition:
+            scheduler._is_running = True
+            self._schedulers.add(scheduler)
+            self._condition.notify_all()
+
+    def _detach(self, scheduler: ScanScheduler):
+        with self._condition:
+            scheduler._is_running = False
+            self._schedulers.discard(scheduler)
+            while scheduler._is_scanning:
+                self._condition.wait()
+
+    def _run(self):
+        with self._condition:
+            while self._is_running:
+                now = monotonic()
+                timeout: Optional[float] = None
+                for scheduler in self._schedulers:
+                    due = scheduler._due()
+                    if due is None:
+                        continue
+                    if due > now:
+                        if timeout is None or due - now < timeout:
+                            timeout = due - now
+                        continue
+                    generation = scheduler._begin()
+                    assert self._executor is not None
+                    self._executor.submit(scheduler._scan, generation)
+                self._condition.wait(timeout)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+watch the directories in the listing cache and invalidate them when
+they change, using inotify on linux and polling elsewhere
+"""
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import os
+from os import path as op
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from threading import Thread, Event, Lock
+
+from .dircache import dircache
+
+logger = logging.getLogger("calamities")
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+watch_mask = (
+    IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+event_header = struct.Struct("iIII")
+
+
+class DirectoryWatcher:
+    """
+    once attached, every directory that the cache lists is watched. on a
+    change, the directory is invalidated in the cache and subscribers are
+    called from the watcher thread with the set of changed directories
+    """
+
+    def __init__(self, cache=dircache, max_watches=8192):
+        self.cache = cache
+        self.max_watches = max_watches
+
+        self._subscribers: List[Callable[[FrozenSet[str]], None]] = []
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self):
+        self.cache.watcher = self
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.cache.watcher is self:
+            self.cache.watcher = None
+        self._stop()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def watch(self, path):
+        raise NotImplementedError
+
+    def _run(self):
+        raise NotImplementedError
+
+    def _stop(self):
+        raise NotImplementedError
+
+    def _close(self):
+        """
+        releases what the watcher holds, also if it was never started
+        """
+        pass
+
+    def _changed(self, dirpaths: Set[str]):
+        if len(dirpaths) == 0:
+            return
+        for dirpath in dirpaths:
+            self.cache.invalidate(dirpath)
+        dirpaths = frozenset(dirpaths)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(dirpaths)
+            except Exception as e:
+                logger.warning("Error in directory watcher callback: %s", e, exc_info=True)
+
+
+class InotifyWatcher(DirectoryWatcher):
+    def __init__(self, *args, **kwargs):
+        super(InotifyWatcher, self).__init__(*args, **kwargs)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._stop_r, self._stop_w = os.pipe()
+        self._fds: Optional[Tuple[int, ...]] = (self._fd, self._stop_r, self._stop_w)
+
+        self._path_by_wd: Dict[int, str] = dict()
+        self._wd_by_path: Dict[str, int] = dict()
+
+    def watch(self, path):
+        with self._lock:
+            if path in self._wd_by_path or len(self._wd_by_path) >= self.max_watches:
+                return
+            wd = self._inotify_add_watch(self._fd, os.fsencode(path), watch_mask)
+            if wd < 0:
+                logger.debug("Cannot watch %s: %s", path, os.strerror(ctypes.get_errno()))
+                return
+            self._path_by_wd[wd] = path
+            self._wd_by_path[path] = wd
+
+    def _stop(self):
+        if self._fds is not None:
+            os.write(self._stop_w, b"\0")
+
+    def _close(self):
+        fds, self._fds = self._fds, None
+        if fds is not None:
+            for fd in fds:
+                os.close(fd)
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                break
+            try:
+                buf = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                continue
+            self._changed(self._parse(buf))
+
+    def _parse(self, buf) -> Set[str]:
+        dirpaths = set()
+        offset = 0
+        while offset + event_header.size <= len(buf):
+            wd, mask, _, length = event_header.unpack_from(buf, offset)
+            offset += event_header.size + length
+
+            if mask & IN_Q_OVERFLOW:  # events were lost
+                self.cache.clear()
+                with self._lock:
+                    dirpaths.update(self._wd_by_path.keys())
+                continue
+
+            with self._lock:
+                path = self._path_by_wd.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:  # watch was removed by the kernel
+                    del self._path_by_wd[wd]
+                    del self._wd_by_path[path]
+            dirpaths.add(path)
+        return dirpaths
+
+
+class PollingWatcher(DirectoryWatcher):
+    def __init__(self, *args, interval=1.0, **kwargs):
+        super(PollingWatcher, self).__init__(*args, **kwargs)
+        self.interval = interval
+
+        self._stat_by_path: Dict[str, Tuple[int, int, int]] = dict()
+        self._stop_event = Event()
+
+    def watch(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            if path in self._stat_by_path or len(self._stat_by_path) >= self.max_watches:
+                return
+            self._stat_by_path[path] = (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def _stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(timeout=self.interval):
+            with self._lock:
+                items = list(self._stat_by_path.items())
+
+            dirpaths = set()
+            for path, stat in items:
+                try:
+                    st = os.stat(path)
+                    newstat = (st.st_dev, st.st_ino, st.st_mtime_ns)
+                except OSError:
+                    newstat = None
+                if newstat == stat:
+                    continue
+                with self._lock:
+                    if newstat is None:
+                        self._stat_by_path.pop(path, None)
+                    else:
+                        self._stat_by_path[path] = newstat
+                dirpaths.add(path)
+
+            self._changed(dirpaths)
+
+
+class ChangedDirectories:
+    """
+    a backend that only lists what a glob needs to match again after the
+    entries of some directories have changed. these are the changed
+    directories themselves, and below them the subdirectories that are
+    new or that had no matches, as the others have not changed. of their
+    parents, only the entries that lead to them are listed
+    """
+
+    def __init__(self, backend, dirpaths, paths: List[str]):
+        self.backend = backend
+
+        # deepest first, so that the first prefix of a path is the one that
+        # decides whether it changed
+        self.prefixes = sorted(
+            {op.join(op.abspath(dirpath), "") for dirpath in dirpaths}, key=len, reverse=True
+        )
+
+        self.unchanged: Dict[str, Set[str]] = dict()
+        for prefix in self.prefixes:
+            try:
+                names = {entry.name for entry in backend.listdir(prefix)}
+            except OSError:
+                names = set()
+            matched = set()
+            for path in paths:
+                if path.startswith(prefix):
+                    name, _, rest = path[len(prefix) :].partition("/")
+                    if len(rest) > 0:
+                        matched.add(name)
+            self.unchanged[prefix] = names & matched
+
+    def _prefix(self, path) -> Optional[str]:
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return prefix
+        return None
+
+    def is_changed(self, path) -> bool:
+        """
+        whether the path needs to be matched again
+        """
+        prefix = self._prefix(path)
+        if prefix is None or len(path) == len(prefix):
+            return False
+        name, _, rest = path[len(prefix) :].partition("/")
+        return len(rest) == 0 or name not in self.unchanged[prefix]
+
+    def listdir(self, path):
+        key = op.join(op.abspath(path or os.curdir), "")
+        is_changed_dir = key in self.unchanged
+        if is_changed_dir or self.is_changed(key):
+            return self.backend.listdir(path)
+        names = {
+            prefix[len(key) :].split("/", 1)[0]
+            for prefix in self.prefixes
+            if len(prefix) > len(key) and prefix.startswith(key)
+        }
+        if len(names) == 0:
+            return tuple()
+        return tuple(entry for entry in self.backend.listdir(path) if entry.name in names)
+
+    def identity(self, path):
+        return self.backend.identity(path)
+
+
+def create_watcher(cache=dircache, max_watches=8192, interval=1.0) -> DirectoryWatcher:
+    """
+    prefer inotify and fall back to polling where it is not available
+    """
+    try:
+        return InotifyWatcher(cache, max_watches=max_watches)
+    except (OSError, AttributeError) as e:
+        logger.debug("Falling back to polling directory watcher: %s", e)
+    return PollingWatcher(cache, max_watches=max_watches, interval=interval)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from os import path as op
+
+import pickle
+
+import pytest
+
+from calamities.config import Config
+from calamities.exclude import ExcludeRules, exclude_rules
+from calamities.pattern import tag_glob
+
+
+def _is_tmp(path, is_dir):
+    return path.endswith(".tmp")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for file in [
+        "sub-01/anat/sub-01_T1w.nii.gz",
+        "sub-01/anat/sub-01_T1w.json",
+        "sub-02/anat/sub-02_T1w.nii.gz",
+        "derivatives/sub-01/anat/sub-01_T1w.nii.gz",
+        "work/sub-01/anat/sub-01_T1w.nii.gz",
+    ]:
+        path = tmp_path / file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize(
+    "rule, path, is_dir, excluded",
+    [
+        # basename globs match at any depth
+        ("*.json", "/data/sub-01/anat/sub-01_T1w.json", False, True),
+        ("*.json", "/data/sub-01/anat/sub-01_T1w.nii.gz", False, False),
+        ("sub-0?", "/data/sub-01", True, True),
+        ("sub-0?", "/data/sub-10", True, False),
+        ("sub-[!1]*", "/data/sub-01", True, True),
+        ("sub-[!1]*", "/data/sub-10", True, False),
+        # globs with a slash match the path at component boundaries
+        ("/data/work", "/data/work", True, True),
+        ("/data/work", "/other/data/work", True, False),
+        ("data/work", "/other/data/work", True, True),
+        ("data/work", "/other/mydata/work", True, False),
+        ("/data/*/anat", "/data/sub-01/anat", True, True),
+        ("/data/*/anat", "/data/sub-01/ses-1/anat", True, False),
+        # ** matches any number of directories
+        ("/data/**/anat", "/data/anat", True, True),
+        ("/data/**/anat", "/data/sub-01/ses-1/anat", True, True),
+        ("/data/**", "/data/sub-01/anat/sub-01_T1w.json", False, True),
+        # a trailing slash only matches directories
+        ("work/", "/data/work", True, True),
+        ("work/", "/data/work", False, False),
+        ("work/", "/data/work/", True, True),
+        # escapes
+        (r"\*", "/data/*", False, True),
+        (r"\*", "/data/a", False, False),
+    ],
+)
+def test_excluded(rule, path, is_dir, excluded):
+    assert ExcludeRules([rule]).excluded(path, is_dir) is excluded
+
+
+def test_negate():
+    rules = ExcludeRules(["*.json", "!sub-01_*.json"])
+    assert rules.excluded("/data/sub-02_T1w.json", False)
+    assert not rules.excluded("/data/sub-01_T1w.json", False)
+
+    # the last rule that matches decides
+    rules = ExcludeRules(["!sub-01_*.json", "*.json"])
+    assert rules.excluded("/data/sub-01_T1w.json", False)
+
+
+def test_predicate():
+    rules = ExcludeRules([_is_tmp])
+    assert rules.excluded("/data/a.tmp", False)
+    assert rules.excluded("/data/b.tmp/", True)
+    assert not rules.excluded("/data/a.txt", False)
+
+
+def test_comments():
+    rules = ExcludeRules(["# a comment", "", "   ", "!", "/", "*.json"])
+    assert len(rules) == 1
+    assert rules.excluded("/data/a.json", False)
+    assert not rules.excluded("/data/# a comment", False)
+
+
+def test_pickle():
+    rules = ExcludeRules(["*.json", "!a.json", _is_tmp])
+    other = pickle.loads(pickle.dumps(rules))
+    assert other.rules == rules.rules
+    for path in ["/a.json", "/b.json", "/c.tmp", "/d.txt"]:
+        assert other.excluded(path, False) == rules.excluded(path, False)
+
+
+def test_exclude_rules(monkeypatch):
+    monkeypatch.setattr(Config, "exclude", ["*.json"])
+    assert exclude_rules().rules == ["*.json"]
+    assert exclude_rules([]).rules == []
+
+    rules = ExcludeRules(["work/"])
+    assert exclude_rules(rules) is rules
+
+
+def test_tag_glob_exclude(tree):
+    pathname = op.join(tree, "**/sub-{subject}_T1w.nii.gz")
+    results = tag_glob(pathname, ["subject"], exclude=["derivatives/", op.join(tree, "work")])
+    assert sorted(results) == [
+        (op.join(tree, "sub-01/anat/sub-01_T1w.nii.gz"), {"subject": "01"}),
+        (op.join(tree, "sub-02/anat/sub-02_T1w.nii.gz"), {"subject": "02"}),
+    ]
+
+
+def test_tag_glob_exclude_files(tree):
+    pathname = op.join(tree, "sub-{subject}/anat/*")
+    results = tag_glob(pathname, ["subject"], exclude=["*.nii.gz", "!sub-02_*"])
+    assert sorted(path for path, _ in results) == [
+        op.join(tree, "sub-01/anat/sub-01_T1w.json"),
+        op.join(tree, "sub-02/anat/sub-02_T1w.nii.gz"),
+    ]
+
+
+def test_tag_glob_exclude_config(tree, monkeypatch):
+    monkeypatch.setattr(Config, "exclude", ["sub-02"])
+    results = tag_glob(op.join(tree, "sub-{subject}"), ["subject"])
+    assert sorted(tagdict["subject"] for _, tagdict in results) == ["01"]
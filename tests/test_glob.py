@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+from os import path as op
+
+import re
+import fnmatch
+
+import pytest
+
+from calamities.fileindex import FileIndex
+from calamities.manifest import ManifestIndex
+from calamities.pattern import GlobRecord, tag_glob, tag_glob_many, tag_match
+from calamities.pattern.re import tag_parse, tokenize, magic_check, special_match
+
+files = [
+    "README",
+    "participants.tsv",
+    "sub-01/anat/sub-01_T1w.nii.gz",
+    "sub-01/anat/sub-01_T1w.json",
+    "sub-01/func/sub-01_task-rest_bold.nii.gz",
+    "sub-01/func/sub-01_task-faces_run-1_bold.nii.gz",
+    "sub-01/func/sub-01_task-faces_run-2_bold.nii.gz",
+    "sub-02/anat/sub-02_T1w.nii.gz",
+    "sub-02/func/sub-02_task-rest_bold.nii.gz",
+    "sub-02/func/sub-02_task-faces_run-1_bold.nii.gz",
+    "sub-10/ses-1/anat/sub-10_ses-1_T1w.nii.gz",
+    "sub-10/ses-2/anat/sub-10_ses-2_T1w.nii.gz",
+    "sub-10/.hidden",
+    "derivatives/fmriprep/sub-01/anat/sub-01_desc-preproc_T1w.nii.gz",
+]
+
+patterns = [
+    "sub-{subject}/anat/sub-{subject}_T1w.nii.gz",
+    "sub-{subject}/func/sub-{subject}_task-{task}_bold.nii.gz",
+    "sub-{subject}/func/sub-{subject}_task-{task}_run-{run}_bold.nii.gz",
+    "sub-{subject}/*/*.nii.gz",
+    "sub-{subject:0[12]}/anat/*",
+    "sub-{subject=1*}/*/*",
+    "sub-*/ses-{session}/anat/*",
+    "sub-??/anat/*_T1w.json",
+    "sub-{subject}/",
+    "sub-{subject}/{suggestion:.*}",
+    "sub-{subject}{suggestion:.*}",
+    "*",
+]
+
+entities = ["subject", "session", "task", "run", "suggestion"]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for file in files:
+        path = tmp_path / file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    return str(tmp_path)
+
+
+def _reference_tag_glob(pathname, entities=None, dironly=False):
+    """
+    tag_glob before the traversal was rewritten
+    """
+    dirname, basename = op.split(pathname)
+    assert dirname and basename != "**"
+    if dirname != pathname and magic_check.search(dirname) is not None:
+        dirs = _reference_tag_glob(dirname, entities, dironly=True)
+    else:
+        dirs = [(dirname, dict())]
+    for dirname, dirtagdict in dirs:
+        match = _reference_translate(basename, entities, dirtagdict)
+        for name in _reference_iterdir(dirname, dironly):
+            matchobj = match(name)
+            if matchobj is not None:
+                tagdict = matchobj.groupdict()
+                tagdict.update(dirtagdict)
+                yield (op.join(dirname, name), tagdict)
+
+
+def _reference_translate(pat, entities, parenttagdict):
+    res = ""
+    entities_in_res = set()
+    for token in tokenize.split(pat):
+        if len(token) == 0:
+            continue
+        matchobj = tag_parse.fullmatch(token)
+        if matchobj is None:
+            fnre = special_match.sub("", fnmatch.translate(token))
+            res += fnre.replace(".*", "[^/]*")
+            continue
+        tag_name = matchobj.group("tag_name")
+        if entities is not None and tag_name not in entities:
+            res += re.escape(token)
+            continue
+        if tag_name in parenttagdict:
+            res += re.escape(parenttagdict[tag_name].rstrip("/"))
+            continue
+        filter_type, filter_str = matchobj.group("filter_type"), matchobj.group("filter")
+        enre = r"[^/]+"
+        if filter_type == ":":
+            enre = filter_str
+        elif filter_type == "=":
+            enre = special_match.sub("", fnmatch.translate(filter_str))
+        if tag_name not in entities_in_res:
+            res += r"(?P<%s>%s)" % (tag_name, enre)
+            entities_in_res.add(tag_name)
+        else:
+            res += r"(?P=%s)" % tag_name
+    return re.compile(res + "/?").fullmatch
+
+
+def _reference_iterdir(dirname, dironly):
+    with os.scandir(dirname) as it:
+        for entry in it:
+            if dironly and not entry.is_dir():
+                continue
+            if entry.name.startswith("."):
+                continue
+            yield op.join(entry.name, "") if entry.is_dir() else entry.name
+
+
+def _sorted(results):
+    return sorted((path, tagdict) for path, tagdict in results)
+
+
+def _rows(columns):
+    values = {entity: columns.column(entity) for entity in columns.entities}
+    return [
+        (path, {entity: column[i] for entity, column in values.items() if column[i] is not None})
+        for i, path in enumerate(columns.paths)
+    ]
+
+
+@pytest.mark.parametrize("pattern", patterns)
+@pytest.mark.parametrize("dironly", [False, True])
+@pytest.mark.parametrize("entities", [entities, ["subject"], None])
+def test_tag_glob_reference(tree, pattern, dironly, entities):
+    pathname = op.join(tree, pattern)
+    expected = _sorted(_reference_tag_glob(pathname, entities, dironly))
+    assert _sorted(tag_glob(pathname, entities, dironly)) == expected
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_tag_glob_max_workers(tree, ordered):
+    pathname = op.join(tree, "sub-{subject}/*/*.nii.gz")
+    expected = list(tag_glob(pathname, entities))
+    results = list(tag_glob(pathname, entities, max_workers=4, ordered=ordered))
+    if ordered:
+        assert results == expected
+    else:
+        assert _sorted(results) == _sorted(expected)
+
+
+def test_tag_glob_records(tree):
+    pathname = op.join(tree, "sub-{subject}/{suggestion:.*}")
+    records = list(tag_glob(pathname, entities, records=True))
+    assert all(isinstance(record, GlobRecord) for record in records)
+    expected = list(tag_glob(pathname, entities))
+    assert [(record.path, record.tagdict) for record in records] == expected
+    for record in records:
+        assert record.is_dir == op.isdir(record.path)
+        assert record.is_file == op.isfile(record.path)
+
+
+def test_tag_glob_file_index(tree, tmp_path_factory):
+    database = str(tmp_path_factory.mktemp("index") / "index.db")
+    pathname = op.join(tree, "sub-{subject}/*/*.nii.gz")
+    with FileIndex(database, root=tree) as index:
+        index.refresh()
+        results = _sorted(tag_glob(pathname, entities, backend=index))
+    assert results == _sorted(tag_glob(pathname, entities))
+
+
+def test_tag_glob_manifest(tree, tmp_path_factory):
+    manifest = str(tmp_path_factory.mktemp("manifest") / "manifest.txt")
+    with open(manifest, "w") as file_handle:
+        for file in files:
+            if not op.basename(file).startswith("."):
+                file_handle.write(op.join(tree, file) + "\n")
+    pathname = op.join(tree, "sub-{subject}/*/*.nii.gz")
+    results = _sorted(tag_glob(pathname, entities, backend=ManifestIndex(manifest)))
+    assert results == _sorted(tag_glob(pathname, entities))
+
+
+def test_tag_glob_processes(tree):
+    pathname = op.join(tree, "sub-{subject}/*/*.nii.gz")
+    results = _sorted(tag_glob(pathname, entities, processes=2))
+    assert results == _sorted(tag_glob(pathname, entities))
+
+
+def test_tag_glob_max_results(tree):
+    pathname = op.join(tree, "sub-{subject}/*/*.nii.gz")
+    assert len(list(tag_glob(pathname, entities, max_results=3))) == 3
+
+
+def test_tag_glob_many(tree):
+    pathnames = [op.join(tree, pattern) for pattern in patterns[:4]]
+    results = list(tag_glob_many(pathnames, entities))
+    for index, pathname in enumerate(pathnames):
+        expected = _sorted(tag_glob(pathname, entities))
+        assert _sorted((path, tagdict) for i, path, tagdict in results if i == index) == expected
+
+
+def test_tag_match(tree):
+    pathname = op.join(tree, "sub-{subject}/func/sub-{subject}_task-{task}_bold.nii.gz")
+    paths = [op.join(tree, file) for file in files]
+    expected = _sorted(tag_glob(pathname, entities))
+    assert _sorted(_rows(tag_match(pathname, paths, entities))) == expected
+
+
+def test_tag_glob_recursive(tree):
+    # dir/** used to match like dir/*
+    results = [path for path, _ in tag_glob(op.join(tree, "sub-10/**"))]
+    assert sorted(results) == [
+        op.join(tree, path)
+        for path in [
+            "sub-10/",
+            "sub-10/ses-1/",
+            "sub-10/ses-1/anat/",
+            "sub-10/ses-1/anat/sub-10_ses-1_T1w.nii.gz",
+            "sub-10/ses-2/",
+            "sub-10/ses-2/anat/",
+            "sub-10/ses-2/anat/sub-10_ses-2_T1w.nii.gz",
+        ]
+    ]
+
+
+def test_tag_glob_recursive_dironly(tree):
+    results = [path for path, _ in tag_glob(op.join(tree, "sub-01/**"), dironly=True)]
+    assert sorted(results) == [
+        op.join(tree, path) for path in ["sub-01/", "sub-01/anat/", "sub-01/func/"]
+    ]
+
+
+def test_tag_glob_recursive_max_depth(tree):
+    results = [path for path, _ in tag_glob(op.join(tree, "sub-10/**"), max_depth=0)]
+    assert sorted(results) == [
+        op.join(tree, path) for path in ["sub-10/", "sub-10/ses-1/", "sub-10/ses-2/"]
+    ]
+
+
+def test_tag_glob_recursive_tags(tree):
+    pathname = op.join(tree, "**/sub-{subject}_T1w.json")
+    assert _sorted(tag_glob(pathname, entities)) == [
+        (op.join(tree, "sub-01/anat/sub-01_T1w.json"), {"subject": "01"}),
+    ]
+
+
+def test_tag_glob_recursive_symlink_loop(tree):
+    os.symlink(op.join(tree, "sub-10"), op.join(tree, "sub-10/ses-1/loop"))
+    results = [path for path, _ in tag_glob(op.join(tree, "sub-10/**"))]
+    loop = op.join(tree, "sub-10/ses-1/loop/")
+    assert [path for path in results if path.startswith(loop)] == [loop]
+    assert len(results) == len(set(results)) == 8
+
+
+def test_tag_glob_relative(tree, monkeypatch):
+    # relative patterns used to list the directory without matching
+    monkeypatch.chdir(tree)
+    assert _sorted(tag_glob("sub-{subject}", entities)) == [
+        ("sub-01/", {"subject": "01"}),
+        ("sub-02/", {"subject": "02"}),
+        ("sub-10/", {"subject": "10"}),
+    ]
+    assert _sorted(tag_glob("sub-{subject}/anat/*.json", entities)) == [
+        ("sub-01/anat/sub-01_T1w.json", {"subject": "01"}),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import pytest
+
+from calamities.pattern import UnsafeFilterError, check_regex, tag_glob
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        r"sub-.*",
+        r"[0-9]+",
+        r".*_.*",
+        r"\d{2}",
+        r"(?:a|b)+",
+    ],
+)
+def test_check_regex_safe(s):
+    assert check_regex(s) is None
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        r"(a+)+",
+        r"(.*_)+x",
+        r"(?:.*_){10}x",
+        r"(?:a|a)+",
+        r".*.*.*",
+        r".*_.*_.*_.*_.*x",
+        r"(a)\1",
+        r"(",
+    ],
+)
+def test_check_regex_unsafe(s):
+    assert check_regex(s) is not None
+
+
+def test_tag_glob_unsafe_filter(tmp_path):
+    (tmp_path / ("_" * 200)).touch()
+
+    with pytest.raises(UnsafeFilterError):
+        list(tag_glob(str(tmp_path / "{x:.*_.*_.*_.*_.*x}")))
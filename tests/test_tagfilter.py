@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from os import path as op
+
+import re
+import pickle
+
+import pytest
+
+from calamities.pattern import tag_glob
+from calamities.pattern.tagfilter import TagFilter, max_alternation
+
+
+def _is_odd(value):
+    return int(value) % 2 == 1
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for subject in ["01", "02", "10"]:
+        (tmp_path / f"sub-{subject}").mkdir()
+    return str(tmp_path)
+
+
+def test_parse_range():
+    assert TagFilter.parse("01..50") == TagFilter(numbers=range(1, 51))
+
+
+def test_parse_values():
+    assert TagFilter.parse("a,b,,c") == TagFilter(values=frozenset(["a", "b", "c"]))
+
+
+@pytest.mark.parametrize("filter_str", ["x*", "01", "1..", "a..b", "[0-9]"])
+def test_parse_glob(filter_str):
+    assert TagFilter.parse(filter_str) is None
+
+
+@pytest.mark.parametrize(
+    "obj, expected",
+    [
+        ("1..3", TagFilter(numbers=range(1, 4))),
+        ("a,b", TagFilter(values=frozenset(["a", "b"]))),
+        ("a", TagFilter(values=frozenset(["a"]))),
+        (range(2, 5), TagFilter(numbers=range(2, 5))),
+        ([1, "02"], TagFilter(values=frozenset(["1", "02"]))),
+        (_is_odd, TagFilter(predicate=_is_odd)),
+    ],
+)
+def test_create(obj, expected):
+    tag_filter = TagFilter.create(obj)
+    assert tag_filter == expected
+    assert hash(tag_filter) == hash(expected)
+    assert TagFilter.create(tag_filter) is tag_filter
+
+
+def test_call_numbers():
+    tag_filter = TagFilter.parse("1..10")
+    assert tag_filter("007")
+    assert tag_filter("10")
+    assert not tag_filter("0")
+    assert not tag_filter("11")
+    assert not tag_filter("x")
+    assert not tag_filter("-1")
+
+
+def test_call_values():
+    tag_filter = TagFilter.parse("rest,faces")
+    assert tag_filter("rest")
+    assert not tag_filter("res")
+    assert not tag_filter("Rest")
+
+
+def test_call_combined():
+    tag_filter = TagFilter(numbers=range(1, 10), predicate=_is_odd)
+    assert tag_filter("03")
+    assert not tag_filter("04")
+    assert not tag_filter("11")
+
+
+def test_regex():
+    assert TagFilter(numbers=range(3)).regex == r"\d+"
+    assert TagFilter(predicate=_is_odd).regex == r"[^/]+"
+
+    regex = TagFilter.parse("a,ab,a.b").regex
+    assert re.fullmatch(regex, "ab") is not None
+    assert re.fullmatch(regex, "a.b") is not None
+    assert re.fullmatch(regex, "axb") is None
+
+    values = frozenset(map(str, range(max_alternation + 1)))
+    assert TagFilter(values=values).regex == r"[^/]+"
+
+
+def test_pickle():
+    tag_filters = [TagFilter.parse("01..50"), TagFilter.parse("a,b"), TagFilter.create(_is_odd)]
+    for tag_filter in tag_filters:
+        assert pickle.loads(pickle.dumps(tag_filter)) == tag_filter
+
+
+def test_tag_glob_filter(tree):
+    pathname = op.join(tree, "sub-{subject=01..02}")
+    assert sorted(path for path, _ in tag_glob(pathname, ["subject"])) == [
+        op.join(tree, "sub-01/"),
+        op.join(tree, "sub-02/"),
+    ]
+    pathname = op.join(tree, "sub-{subject=02,10}")
+    assert sorted(path for path, _ in tag_glob(pathname, ["subject"])) == [
+        op.join(tree, "sub-02/"),
+        op.join(tree, "sub-10/"),
+    ]
+
+
+def test_tag_glob_tag_filters(tree):
+    pathname = op.join(tree, "sub-{subject}")
+    results = tag_glob(pathname, ["subject"], tag_filters={"subject": range(2, 11)})
+    assert sorted(tagdict["subject"] for _, tagdict in results) == ["02", "10"]
+    results = tag_glob(pathname, ["subject"], tag_filters={"subject": _is_odd})
+    assert sorted(tagdict["subject"] for _, tagdict in results) == ["01"]